@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Benchmark of the proxmox_export.py crawl against a replayed Proxmox cluster
+
+Crawls a ReplayProxmox stand-in answering from a cassette (recorded with PROXMOX_RECORD) or,
+without --cassette, from a synthetic cluster built from the configs of bench_parser.py. The
+cluster can be scaled to any number of guests and nodes first. Reports wall time, Proxmox
+calls per endpoint, phase timings and peak RSS. No Proxmox connection is needed.
+
+    python benchmarks/bench_export.py [--cassette cluster.json.gz] [--guests 50000] [--nodes 100]
+                                      [--latency-scale 0] [--inventory nodes] [--workers 32]
+
+--latency-scale 0 replays without the recorded latencies, which leaves the crawl's own CPU
+cost (parsing, record building, hashing).
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import resource
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+import proxmox_export  # noqa: E402
+from bench_parser import generate  # noqa: E402
+from proxmox_cassette import Cassette, ReplayProxmox, first_response, scale  # noqa: E402
+
+# Latencies of the synthetic cluster's calls in seconds
+SYNTHETIC_LATENCY = {"inventory": 0.05, "config": 0.01, "agent": 0.03}
+
+
+def synthetic_cassette(count, nodes=3):
+    """Return a cassette of count guests with bench_parser configs; QEMU guests answer their agent"""
+    cassette = Cassette()
+    node_names = [f"pve{n + 1}" for n in range(nodes)]
+    cassette.add("version", SYNTHETIC_LATENCY["inventory"], "ok", {"version": "8.2.4", "release": "8.2"})
+    cassette.add("nodes", SYNTHETIC_LATENCY["inventory"], "ok",
+                 [{"node": node, "id": f"node/{node}", "status": "online", "type": "node"} for node in node_names])
+
+    resources = []
+    node_lists = {}
+    for i, (vtype, config) in enumerate(generate(count)):
+        vmid = 100 + i
+        node = node_names[i % nodes]
+        name = config.get("name") or config.get("hostname")
+        entry = {"vmid": vmid, "name": name, "status": "stopped" if i % 10 == 9 else "running",
+                 "maxmem": int(config["memory"]) * 1024 * 1024, "maxcpu": config["cores"], "uptime": 1000 + i}
+        resources.append(dict(entry, id=f"{vtype}/{vmid}", type=vtype, node=node))
+        node_lists.setdefault((node, vtype), []).append(entry)
+        cassette.add(f"nodes/{node}/{vtype}/{vmid}/config", SYNTHETIC_LATENCY["config"], "ok", config)
+        if vtype == "qemu":
+            interfaces = [{"name": "lo", "hardware-address": "00:00:00:00:00:00",
+                           "ip-addresses": [{"ip-address": "127.0.0.1", "ip-address-type": "ipv4", "prefix": 8}]}]
+            for n, key in enumerate(sorted(k for k in config if k.startswith("net"))):
+                mac = config[key].split(",")[0].split("=")[1].lower()
+                interfaces.append({"name": f"ens{18 + n}", "hardware-address": mac, "ip-addresses": [
+                    {"ip-address": f"10.{n}.{vmid // 250 % 250}.{vmid % 250 + 1}", "ip-address-type": "ipv4", "prefix": 24},
+                ]})
+            cassette.add(f"nodes/{node}/qemu/{vmid}/agent/network-get-interfaces", SYNTHETIC_LATENCY["agent"], "ok",
+                         {"result": interfaces})
+
+    cassette.add("cluster/resources?type=vm", SYNTHETIC_LATENCY["inventory"], "ok", resources)
+    for node in node_names:
+        for vtype in ("qemu", "lxc"):
+            cassette.add(f"nodes/{node}/{vtype}", SYNTHETIC_LATENCY["inventory"], "ok", node_lists.get((node, vtype), []))
+    return cassette
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cassette", help="recorded cassette, default: a synthetic cluster")
+    parser.add_argument("--guests", type=int, help="scale the cluster to this many guests")
+    parser.add_argument("--nodes", type=int, help="number of nodes of the scaled cluster")
+    parser.add_argument("--synthetic-guests", type=int, default=1000, help="guests of the synthetic cluster")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="factor for the recorded latencies")
+    parser.add_argument("--inventory", choices=["resources", "nodes"], default=proxmox_export.EXPORT_INVENTORY)
+    parser.add_argument("--workers", type=int, default=proxmox_export.EXPORT_WORKERS)
+    parser.add_argument("--node-workers", type=int, default=proxmox_export.EXPORT_NODE_WORKERS)
+    args = parser.parse_args()
+
+    if args.cassette:
+        cassette = Cassette.load(args.cassette)
+        print(f"INFO: Loaded {len(cassette)} responses from {args.cassette}")
+    else:
+        cassette = synthetic_cassette(args.synthetic_guests)
+        print(f"INFO: Generated a synthetic cluster of {args.synthetic_guests} guests")
+    if args.guests or args.nodes:
+        start = time.perf_counter()
+        cassette = scale(cassette, args.guests or args.synthetic_guests, args.nodes)
+        print(f"INFO: Scaled to {args.guests} guests on {len(first_response(cassette, 'nodes'))} nodes "
+              f"in {time.perf_counter() - start:.1f}s")
+
+    proxmox = ReplayProxmox(cassette, args.latency_scale)
+    del cassette
+    proxmox_export.metrics.reset()
+    start = time.perf_counter()
+    exported = 0
+    # The crawl logs every guest, only the results are of interest here
+    with contextlib.redirect_stdout(io.StringIO()):
+        nodes = proxmox.nodes.get()
+        for _ in proxmox_export.crawl(proxmox, nodes, workers=args.workers, node_workers=args.node_workers,
+                                      inventory=args.inventory):
+            exported += 1
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+    report = proxmox_export.metrics.report()
+    print(f"INFO: Crawled {exported} guests with inventory={args.inventory}, {args.workers} workers "
+          f"({args.node_workers} per node): {elapsed:.2f}s, {exported / elapsed:.0f} guests/s, "
+          f"peak RSS {peak_rss:.1f} MB")
+    for request in report["requests"]:
+        print(f"INFO:   {request['method']} {request['endpoint']:<55} {request['count']:>8} calls, "
+              f"{request['errors']} errors, {request['seconds']:.1f}s")
+    for name, phase in report["phases"].items():
+        print(f"INFO:   phase {name:<10} {phase['count']:>8}x {phase['seconds']:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
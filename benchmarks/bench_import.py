@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Benchmark of netbox_import.py against the in-memory NetBox stand-in of fake_netbox.py
+
+Generates synthetic snapshots, imports each into an empty fake NetBox and then once more
+(everything unchanged), and reports wall time, NetBox requests per endpoint and the peak RSS
+of the importer. No NetBox is needed; the importer runs as a subprocess, the fake in this one.
+
+    python benchmarks/bench_import.py [--sizes 100 1000 10000] [--latency 0.002] [--error-rate 0.01]
+                                      [--max-requests-per-guest 5] [--json results.json]
+
+With --max-requests-per-guest the exit status is 1 if any import sent more requests per guest,
+which catches regressions in request amplification in CI.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+from fake_netbox import FakeNetBox, make_server  # noqa: E402
+from snapshot import SnapshotWriter  # noqa: E402
+
+IMPORTER = os.path.join(BENCH_DIR, "..", "netbox_import.py")
+
+
+def guest_record(i):
+    """Return a synthetic exported guest; about one in ten is offline, the others have 1-3 disks
+    and 1-2 interfaces with unique MAC and IP addresses"""
+    host = f"pve{i % 8 + 1}"
+    if i % 10 == 9:
+        return {"name": f"bench-{i}", "type": "qemu", "status": "offline", "host": host}
+    vtype = "lxc" if i % 3 == 2 else "qemu"
+    interfaces = []
+    for n in range(1 + i % 2):
+        ips = [{"ip": f"10.{n}.{i // 250 % 250}.{i % 250 + 1}", "prefix": 16}]
+        if i % 4 == 0:
+            ips.append({"ip": f"2001:db8:{n}::{i:x}", "prefix": 64})
+        interfaces.append({"name": f"eth{n}", "mac": f"bc:24:{n:02x}:{i >> 16 & 255:02x}:{i >> 8 & 255:02x}:{i & 255:02x}",
+                           "ip_addresses": ips})
+    return {
+        "name": f"bench-{i}",
+        "type": vtype,
+        "status": "running",
+        "ostype": "debian" if vtype == "lxc" else None,
+        "vcpu": 1 << i % 4,
+        "ram_mb": 1024 << i % 4,
+        "disks": [{"name": f"scsi{d}" if vtype == "qemu" else "rootfs" if d == 0 else f"mp{d - 1}",
+                   "size_gb": 8 << d, "description": f"local-zfs:vm-{i}-disk-{d},size={8 << d}G"}
+                  for d in range(1 + i % 3)],
+        "interfaces": interfaces,
+        "host": host,
+    }
+
+
+def write_snapshot(path, count):
+    with SnapshotWriter(path) as snapshot:
+        for i in range(count):
+            snapshot.write(guest_record(i))
+
+
+def run_import(snapshot, url, log_path):
+    """Run the importer on snapshot, returns (exit code, wall time, peak RSS in MB)"""
+    env = dict(
+        os.environ,
+        NETBOX_URL=url,
+        NETBOX_TOKEN="benchmark",
+        CLUSTER_ID="1",
+        VERIFY_SSL="false",
+        VRF_ID="",
+        IMPORT_JOURNAL_FILE="",
+        IMPORT_METRICS_FILE="",
+        IMPORT_REPORT_FILE="",
+    )
+    with open(log_path, "w") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, IMPORTER, snapshot], stdout=log, stderr=subprocess.STDOUT, env=env)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return process.returncode, elapsed, rss_mb
+
+
+def benchmark(size, args, work_dir):
+    snapshot = os.path.join(work_dir, f"bench-{size}.jsonl")
+    write_snapshot(snapshot, size)
+
+    netbox = FakeNetBox(args.latency, args.object_latency, args.error_rate, seed=size)
+    server = make_server(netbox)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    results = []
+    try:
+        for run in ("initial", "unchanged"):
+            log_path = os.path.join(work_dir, f"bench-{size}-{run}.log")
+            netbox.reset_stats()
+            code, elapsed, rss_mb = run_import(snapshot, url, log_path)
+            stats = netbox.stats()
+            requests = sum(stats["requests"].values())
+            result = {
+                "guests": size,
+                "run": run,
+                "exit_code": code,
+                "seconds": round(elapsed, 3),
+                "peak_rss_mb": round(rss_mb, 1),
+                "requests": requests,
+                "requests_per_guest": round(requests / size, 2),
+                "injected_errors": sum(stats["errors"].values()),
+                "endpoints": {f"{method} {endpoint}": count for (method, endpoint), count in
+                              sorted(stats["requests"].items(), key=lambda item: (item[0][1], item[0][0]))},
+                "objects": stats["objects"],
+            }
+            results.append(result)
+            print_result(result)
+            if code != 0:
+                with open(log_path) as log:
+                    tail = log.readlines()[-10:]
+                print(f"ERROR: Import of {size} guests exited with {code}, last output:\n{''.join(tail)}")
+                break
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def print_result(result):
+    print(f"INFO: {result['guests']} guests, {result['run']} import: {result['seconds']:.2f}s, "
+          f"{result['requests']} requests ({result['requests_per_guest']} per guest, "
+          f"{result['injected_errors']} injected errors), peak RSS {result['peak_rss_mb']:.1f} MB")
+    for endpoint, count in result["endpoints"].items():
+        print(f"INFO:   {endpoint:<45} {count:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="guests per snapshot")
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds the fake NetBox adds to every request")
+    parser.add_argument("--object-latency", type=float, default=0.0005, help="seconds added per object of a write")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--max-requests-per-guest", type=float, help="fail if an import needs more requests per guest")
+    parser.add_argument("--json", metavar="FILE", help="also write the results as JSON")
+    parser.add_argument("--keep", action="store_true", help="keep the snapshots and importer logs")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench-import-")
+    results = []
+    try:
+        for size in args.sizes:
+            results += benchmark(size, args, work_dir)
+    finally:
+        if args.keep:
+            print(f"INFO: Snapshots and logs kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    failed = [r for r in results if r["exit_code"] != 0]
+    if args.max_requests_per_guest is not None:
+        for r in results:
+            if r["requests_per_guest"] > args.max_requests_per_guest:
+                print(f"ERROR: {r['run'].capitalize()} import of {r['guests']} guests sent {r['requests_per_guest']} "
+                      f"requests per guest, more than {args.max_requests_per_guest}")
+                failed.append(r)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Micro-benchmark for the Proxmox config parsing of proxmox_export.py
+
+Generates synthetic QEMU and LXC configs and times parse_guest_config() over all of them.
+No Proxmox connection is needed.
+
+    python benchmarks/bench_parser.py [--guests 100000] [--repeat 3]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from proxmox_export import parse_guest_config  # noqa: E402
+
+
+def mac(rng):
+    return "BC:24:11:" + ":".join(f"{rng.randrange(256):02X}" for _ in range(3))
+
+
+def qemu_config(vmid, rng):
+    config = {
+        "name": f"vm-{vmid}",
+        "cores": rng.choice([1, 2, 4, 8]),
+        "memory": str(rng.choice([1024, 2048, 4096, 16384])),
+        "ostype": rng.choice(["l26", "win11", "other"]),
+        "scsihw": "virtio-scsi-single",
+        "boot": "order=scsi0;ide2;net0",
+        "ide2": "local:iso/debian-12.iso,media=cdrom,size=628M",
+        "ide0": f"local-lvm:vm-{vmid}-cloudinit,media=cdrom",
+        "agent": "1",
+        "digest": f"{vmid:040x}",
+    }
+    for i in range(rng.randint(1, 4)):
+        bus = rng.choice(["scsi", "virtio", "sata"])
+        size = rng.choice(["32G", "100G", "512M", "2T"])
+        config[f"{bus}{i}"] = f"local-zfs:vm-{vmid}-disk-{i},cache=writethrough,discard=on,iothread=1,size={size},ssd=1"
+    for i in range(rng.randint(1, 3)):
+        config[f"net{i}"] = f"virtio={mac(rng)},bridge=vmbr{i},firewall=1,tag={100 + i}"
+    return config
+
+
+def lxc_config(vmid, rng):
+    config = {
+        "hostname": f"ct-{vmid}",
+        "cores": rng.choice([1, 2]),
+        "memory": rng.choice([512, 1024, 2048]),
+        "ostype": rng.choice(["debian", "ubuntu", "alpine"]),
+        "rootfs": f"local-zfs:subvol-{vmid}-disk-0,size={rng.choice(['8G', '20G'])}",
+        "digest": f"{vmid:040x}",
+    }
+    for i in range(rng.randint(0, 2)):
+        config[f"mp{i}"] = f"local-zfs:subvol-{vmid}-disk-{i + 1},mp=/data{i},size={rng.choice(['100G', '1T'])}"
+    for i in range(rng.randint(1, 2)):
+        config[f"net{i}"] = (f"name=eth{i},bridge=vmbr{i},hwaddr={mac(rng)},ip=10.{i}.{vmid % 250}.{vmid % 200}/24,"
+                             f"ip6=2001:db8:{i}::{vmid:x}/64,type=veth")
+    return config
+
+
+def generate(count, seed=42):
+    rng = random.Random(seed)
+    guests = []
+    for vmid in range(100, 100 + count):
+        if rng.random() < 0.7:
+            guests.append(("qemu", qemu_config(vmid, rng)))
+        else:
+            guests.append(("lxc", lxc_config(vmid, rng)))
+    return guests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--guests", type=int, default=100000, help="number of synthetic guests")
+    parser.add_argument("--repeat", type=int, default=3, help="timed passes, the best one is reported")
+    args = parser.parse_args()
+
+    print(f"INFO: Generating {args.guests} synthetic guest configs")
+    guests = generate(args.guests)
+
+    best = None
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        disks = interfaces = 0
+        for vtype, config in guests:
+            parsed = parse_guest_config(config, vtype, {})
+            disks += len(parsed["disks"])
+            interfaces += len(parsed["interfaces"])
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    print(f"INFO: Parsed {args.guests} guests ({disks} disks, {interfaces} interfaces)")
+    print(f"INFO: Best of {args.repeat}: {best:.3f}s total, {best / args.guests * 1e6:.1f}us per guest")
+
+
+if __name__ == "__main__":
+    main()
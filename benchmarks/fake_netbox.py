@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""In-memory NetBox stand-in serving the API endpoints netbox_import.py uses
+
+Implements paginated and filtered lists (with next links and the fields parameter), single
+and bulk POST/PATCH, GETs by ID and the cluster query of the GraphQL loader, for clusters,
+platforms, VMs, virtual disks, VM interfaces, MAC and IP addresses. Every request can be
+delayed (a fixed latency plus a cost per object of bulk writes) and a share of them can fail
+with 503, which the importer retries. Requests are counted per method and endpoint.
+
+    python benchmarks/fake_netbox.py [--port 8000] [--latency 0.01] [--error-rate 0.01]
+
+Cluster 1 exists from the start. There is no authentication and no validation beyond what
+the importer relies on, e.g. platform names are unique.
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+ENDPOINTS = (
+    "virtualization/clusters",
+    "dcim/platforms",
+    "virtualization/virtual-machines",
+    "virtualization/virtual-disks",
+    "virtualization/interfaces",
+    "dcim/mac-addresses",
+    "ipam/ip-addresses",
+)
+# Fields of nested objects, sent as IDs and returned as {"id": ...}
+REFERENCES = ("cluster", "platform", "virtual_machine", "vrf")
+# Filters answered from an index instead of scanning a whole table
+INDEXED = {
+    "dcim/platforms": ("name",),
+    "virtualization/virtual-machines": ("name", "cluster_id"),
+    "virtualization/virtual-disks": ("virtual_machine_id",),
+    "virtualization/interfaces": ("virtual_machine_id",),
+    "dcim/mac-addresses": ("mac_address",),
+    "ipam/ip-addresses": ("address",),
+}
+MAX_PAGE_SIZE = 1000
+PATH_RE = re.compile(r"^/api/(\w+/[\w-]+)/(?:(\d+)/)?$")
+CLUSTER_ID_RE = re.compile(r'cluster_id:\s*(?:"(\d+)"|\$cluster_id\b)')
+
+
+def index_value(field, obj):
+    """Return the value of obj that the filter field matches, normalized like the filter"""
+    if field == "address":
+        return (obj.get("address") or "").split("/")[0].lower()
+    if field == "mac_address":
+        return (obj.get("mac_address") or "").lower()
+    if field.endswith("_id"):
+        value = obj.get(field[:-3])
+        return str(value["id"]) if isinstance(value, dict) else "null" if value is None else str(value)
+    return str(obj.get(field))
+
+
+def filter_value(field, value):
+    if field == "address":
+        return value.split("/")[0].lower()
+    if field == "mac_address":
+        return value.lower()
+    return value
+
+
+class FakeNetBox:
+    """State, request counters and request handling of the stand-in, independent of HTTP"""
+
+    def __init__(self, latency=0.0, object_latency=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.object_latency = object_latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tables = {endpoint: {} for endpoint in ENDPOINTS}
+        self.indexes = {(endpoint, field): {} for endpoint, fields in INDEXED.items() for field in fields}
+        self.next_id = 1
+        self.requests = Counter()  # (method, endpoint) -> requests
+        self.errors = Counter()    # (method, endpoint) -> injected errors
+        self.store("virtualization/clusters", {"name": "benchmark"})
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": Counter(self.requests),
+                "errors": Counter(self.errors),
+                "objects": {endpoint: len(table) for endpoint, table in self.tables.items()},
+            }
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests.clear()
+            self.errors.clear()
+
+    def handle(self, method, path, body, host):
+        """Answer one API request, returns (status, response body)"""
+        url = urlparse(path)
+        if url.path == "/graphql/" and method == "POST":
+            endpoint, obj_id = "graphql", None
+        else:
+            match = PATH_RE.match(url.path)
+            if not match or match.group(1) not in self.tables:
+                return 404, {"detail": "Not found."}
+            endpoint, obj_id = match.group(1), int(match.group(2)) if match.group(2) else None
+
+        objects = len(body) if isinstance(body, list) else 1
+        delay = self.latency + (self.object_latency * objects if method in ("POST", "PATCH") else 0)
+        if delay:
+            time.sleep(delay)
+        with self.lock:
+            self.requests[(method, endpoint)] += 1
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors[(method, endpoint)] += 1
+                return 503, {"detail": "Injected error"}
+
+            if endpoint == "graphql":
+                return self.graphql(body)
+            if method == "GET":
+                if obj_id is not None:
+                    obj = self.tables[endpoint].get(obj_id)
+                    return (200, obj) if obj else (404, {"detail": "Not found."})
+                return self.list(endpoint, parse_qs(url.query), host)
+            if method == "POST" and obj_id is None:
+                return self.create(endpoint, body)
+            if method == "PATCH":
+                return self.update(endpoint, body if obj_id is None else dict(body, id=obj_id))
+            return 405, {"detail": f'Method "{method}" not allowed.'}
+
+    def list(self, endpoint, params, host):
+        table = self.tables[endpoint]
+        filters = {key: values for key, values in params.items() if key not in ("limit", "offset", "fields", "brief", "exclude")}
+
+        candidates = None
+        for field in INDEXED.get(endpoint, ()):
+            if field in filters:
+                index = self.indexes[(endpoint, field)]
+                candidates = set().union(*(index.get(filter_value(field, value), ()) for value in filters.pop(field)))
+                break
+        ids = sorted(candidates) if candidates is not None else table
+        rows = [table[obj_id] for obj_id in ids if self.matches(endpoint, table[obj_id], filters)]
+
+        limit = int(params.get("limit", ["50"])[0]) or MAX_PAGE_SIZE
+        limit = min(limit, MAX_PAGE_SIZE)
+        offset = int(params.get("offset", ["0"])[0])
+        page = rows[offset:offset + limit]
+        if "fields" in params:
+            fields = set(params["fields"][0].split(","))
+            page = [{key: value for key, value in obj.items() if key in fields} for obj in page]
+        if "exclude" in params:
+            excluded = set(params["exclude"][0].split(","))
+            page = [{key: value for key, value in obj.items() if key not in excluded} for obj in page]
+
+        next_url = None
+        if offset + limit < len(rows):
+            query = dict(params, offset=[str(offset + limit)], limit=[str(limit)])
+            next_url = f"http://{host}/api/{endpoint}/?{urlencode(query, doseq=True)}"
+        return 200, {"count": len(rows), "next": next_url, "previous": None, "results": page}
+
+    def matches(self, endpoint, obj, filters):
+        for field, values in filters.items():
+            if field == "cluster_id" and endpoint == "virtualization/interfaces":
+                vm = self.tables["virtualization/virtual-machines"].get(obj["virtual_machine"]["id"])
+                value = index_value(field, vm) if vm else "null"
+            else:
+                value = index_value(field, obj)
+            if value not in [filter_value(field, v) for v in values]:
+                return False
+        return True
+
+    def create(self, endpoint, body):
+        items = body if isinstance(body, list) else [body]
+        if endpoint == "dcim/platforms":
+            names = {obj["name"] for obj in self.tables[endpoint].values()}
+            if any(item.get("name") in names for item in items):
+                return 400, {"name": ["Platform with this Name already exists."]}
+        created = [self.store(endpoint, item) for item in items]
+        return 201, created if isinstance(body, list) else created[0]
+
+    def update(self, endpoint, body):
+        items = body if isinstance(body, list) else [body]
+        table = self.tables[endpoint]
+        if any(item.get("id") not in table for item in items):
+            return 400, {"detail": "Object not found."}
+        updated = [self.store(endpoint, item, table[item["id"]]) for item in items]
+        return 200, updated if isinstance(body, list) else updated[0]
+
+    def store(self, endpoint, data, existing=None):
+        """Create or update an object the way NetBox represents it and keep the indexes current"""
+        obj = dict(existing or {})
+        for field, value in data.items():
+            if field in REFERENCES and value is not None and not isinstance(value, dict):
+                value = {"id": value}
+            elif field == "status" and isinstance(value, str):
+                value = {"value": value, "label": value.title()}
+            elif field == "mac_address" and isinstance(value, str):
+                value = value.upper()
+            obj[field] = value
+        if endpoint == "ipam/ip-addresses":
+            obj.setdefault("vrf", None)
+        if existing is None:
+            obj["id"] = self.next_id
+            self.next_id += 1
+
+        for field in INDEXED.get(endpoint, ()):
+            index = self.indexes[(endpoint, field)]
+            if existing is not None:
+                index.get(index_value(field, existing), set()).discard(obj["id"])
+            index.setdefault(index_value(field, obj), set()).add(obj["id"])
+        self.tables[endpoint][obj["id"]] = obj
+        return obj
+
+    def graphql(self, body):
+        """Answer the cluster state query of netbox_import.load_cluster_state_graphql()"""
+        match = CLUSTER_ID_RE.search(body.get("query", ""))
+        variables = body.get("variables") or {}
+        cluster_id = match and (match.group(1) or variables.get("cluster_id"))
+        if not cluster_id:
+            return 200, {"errors": [{"message": "Unsupported query"}]}
+        offset, limit = variables.get("offset", 0), variables.get("limit", MAX_PAGE_SIZE)
+
+        vm_ids = sorted(self.indexes[("virtualization/virtual-machines", "cluster_id")].get(str(cluster_id), ()))
+        disk_index = self.indexes[("virtualization/virtual-disks", "virtual_machine_id")]
+        interface_index = self.indexes[("virtualization/interfaces", "virtual_machine_id")]
+        vms = []
+        for vm_id in vm_ids[offset:offset + limit]:
+            vm = self.tables["virtualization/virtual-machines"][vm_id]
+            disks = [self.tables["virtualization/virtual-disks"][i] for i in sorted(disk_index.get(str(vm_id), ()))]
+            interfaces = [self.tables["virtualization/interfaces"][i] for i in sorted(interface_index.get(str(vm_id), ()))]
+            vms.append({
+                "id": str(vm_id),
+                "name": vm["name"],
+                "status": (vm.get("status") or {}).get("value", "active").upper(),
+                "vcpus": f"{float(vm['vcpus']):.2f}" if vm.get("vcpus") is not None else None,
+                "memory": vm.get("memory"),
+                "comments": vm.get("comments", ""),
+                "cluster": {"id": str(vm["cluster"]["id"])} if vm.get("cluster") else None,
+                "platform": {"id": str(vm["platform"]["id"])} if vm.get("platform") else None,
+                "virtualdisks": [{"id": str(d["id"]), "name": d["name"], "size": d.get("size"),
+                                  "description": d.get("description", "")} for d in disks],
+                "interfaces": [{"id": str(i["id"]), "name": i["name"]} for i in interfaces],
+            })
+        return 200, {"data": {"virtual_machine_list": vms}}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send headers and body in one segment, or delayed ACKs add ~40ms to every response
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+    netbox = None  # FakeNetBox, set by make_server()
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        status, response = self.netbox.handle(self.command, self.path, body, self.headers.get("Host"))
+
+        data = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PATCH = handle_request
+
+
+def make_server(netbox, host="127.0.0.1", port=0):
+    """Return a threading HTTP server for netbox, port 0 picks a free port (see server_address)"""
+    handler = type("FakeNetBoxHandler", (Handler,), {"netbox": netbox})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--object-latency", type=float, default=0.0, help="seconds added per object of a write")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    args = parser.parse_args()
+
+    server = make_server(FakeNetBox(args.latency, args.object_latency, args.error_rate), port=args.port)
+    print(f"INFO: Fake NetBox listening on http://127.0.0.1:{server.server_address[1]} (cluster ID 1)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
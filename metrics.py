@@ -0,0 +1,221 @@
+"""Run metrics of proxmox_export.py and netbox_import.py
+
+Each script keeps one Metrics registry with its API requests (count, errors and a latency
+histogram per endpoint and method), the time spent in its phases and counts such as the
+objects it created, updated or left unchanged. At the end of a run the registry is written
+as an OpenMetrics textfile, for node_exporter's textfile collector, and/or as a JSON run
+report. All values describe the last run: counts are gauges, not counters.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from profiling import tracer
+
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def escape_label(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def count_key(name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+class Metrics:
+    """Thread-safe registry of the requests, phase timings and counts of one run"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far and start a new run"""
+        with self.lock:
+            self.started = time.time()
+            self.requests = {}  # (endpoint, method) -> {"buckets": [count per bucket, then +Inf], "seconds", "errors"}
+            self.phases = {}    # phase -> [count, seconds]
+            self.counts = {}    # (name, ((label, value), ...)) -> value
+
+    def observe_request(self, method, endpoint, seconds, error=False):
+        """Record one request to endpoint (with IDs replaced by placeholders) and its latency"""
+        with self.lock:
+            request = self.requests.get((endpoint, method))
+            if request is None:
+                request = self.requests[(endpoint, method)] = {
+                    "buckets": [0] * (len(LATENCY_BUCKETS) + 1), "seconds": 0.0, "errors": 0,
+                }
+            index = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+            request["buckets"][index] += 1
+            request["seconds"] += seconds
+            if error:
+                request["errors"] += 1
+
+    @contextmanager
+    def request(self, method, endpoint):
+        """Time the enclosed request, an exception counts as an error; traced as a span while profiling"""
+        start = time.monotonic()
+        try:
+            with tracer.span(f"{method} {endpoint}", "request"):
+                yield
+        except BaseException:
+            self.observe_request(method, endpoint, time.monotonic() - start, error=True)
+            raise
+        self.observe_request(method, endpoint, time.monotonic() - start)
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            phase = self.phases.setdefault(name, [0, 0.0])
+            phase[0] += 1
+            phase[1] += seconds
+
+    @contextmanager
+    def phase(self, name):
+        """Add the time spent in the enclosed block to a phase; concurrent phases add up"""
+        start = time.monotonic()
+        try:
+            with tracer.span(name, "phase"):
+                yield
+        finally:
+            self.add_phase(name, time.monotonic() - start)
+
+    def count(self, name, value=1, **labels):
+        """Add value to a count, e.g. count("objects", kind="vm", outcome="created")"""
+        key = count_key(name, labels)
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = count_key(name, labels)
+        with self.lock:
+            self.counts[key] = value
+
+    def report(self):
+        """Return everything recorded as a JSON-serializable run report"""
+        with self.lock:
+            requests = []
+            for (endpoint, method), request in sorted(self.requests.items()):
+                cumulative, buckets = 0, {}
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), request["buckets"]):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                requests.append({
+                    "endpoint": endpoint, "method": method, "count": cumulative, "errors": request["errors"],
+                    "seconds": round(request["seconds"], 6), "buckets": buckets,
+                })
+            return {
+                "script": self.prefix,
+                "started": datetime.fromtimestamp(self.started, timezone.utc).isoformat(timespec="seconds"),
+                "duration_seconds": round(time.time() - self.started, 3),
+                "requests": requests,
+                "phases": {name: {"count": count, "seconds": round(seconds, 6)}
+                           for name, (count, seconds) in sorted(self.phases.items())},
+                "counts": [{"name": name, "labels": dict(labels), "value": value}
+                           for (name, labels), value in sorted(self.counts.items())],
+            }
+
+    def merge(self, report):
+        """Add the requests, phases and counts of another run's report, e.g. of a shard process"""
+        with self.lock:
+            for entry in report["requests"]:
+                request = self.requests.setdefault((entry["endpoint"], entry["method"]), {
+                    "buckets": [0] * (len(LATENCY_BUCKETS) + 1), "seconds": 0.0, "errors": 0,
+                })
+                previous = 0
+                for i, cumulative in enumerate(entry["buckets"].values()):
+                    request["buckets"][i] += cumulative - previous
+                    previous = cumulative
+                request["seconds"] += entry["seconds"]
+                request["errors"] += entry["errors"]
+            for name, entry in report["phases"].items():
+                phase = self.phases.setdefault(name, [0, 0.0])
+                phase[0] += entry["count"]
+                phase[1] += entry["seconds"]
+            for entry in report["counts"]:
+                key = count_key(entry["name"], entry["labels"])
+                self.counts[key] = self.counts.get(key, 0) + entry["value"]
+
+    def openmetrics(self):
+        """Return the recorded metrics in the OpenMetrics text format"""
+        report = self.report()
+        prefix = self.prefix
+        lines = [
+            f"# HELP {prefix}_last_run_timestamp_seconds Start time of the last run.",
+            f"# TYPE {prefix}_last_run_timestamp_seconds gauge",
+            f"{prefix}_last_run_timestamp_seconds {self.started:.3f}",
+            f"# HELP {prefix}_run_duration_seconds Wall time of the last run.",
+            f"# TYPE {prefix}_run_duration_seconds gauge",
+            f"{prefix}_run_duration_seconds {report['duration_seconds']}",
+        ]
+
+        if report["requests"]:
+            lines += [f"# HELP {prefix}_requests API requests per endpoint and method, retries included.",
+                      f"# TYPE {prefix}_requests gauge"]
+            lines += [f"{prefix}_requests{format_labels([('endpoint', r['endpoint']), ('method', r['method'])])} {r['count']}"
+                      for r in report["requests"]]
+            lines += [f"# HELP {prefix}_request_errors Failed API requests per endpoint and method.",
+                      f"# TYPE {prefix}_request_errors gauge"]
+            lines += [f"{prefix}_request_errors{format_labels([('endpoint', r['endpoint']), ('method', r['method'])])} {r['errors']}"
+                      for r in report["requests"]]
+            lines += [f"# HELP {prefix}_request_duration_seconds API request latency per endpoint and method.",
+                      f"# TYPE {prefix}_request_duration_seconds histogram"]
+            for r in report["requests"]:
+                labels = [("endpoint", r["endpoint"]), ("method", r["method"])]
+                for bound, count in r["buckets"].items():
+                    le = bound if bound == "+Inf" else format_value(float(bound))
+                    lines.append(f"{prefix}_request_duration_seconds_bucket{format_labels(labels + [('le', le)])} {count}")
+                lines.append(f"{prefix}_request_duration_seconds_count{format_labels(labels)} {r['count']}")
+                lines.append(f"{prefix}_request_duration_seconds_sum{format_labels(labels)} {format_value(r['seconds'])}")
+
+        if report["phases"]:
+            lines += [f"# HELP {prefix}_phase_duration_seconds Time spent per phase, summed over threads.",
+                      f"# TYPE {prefix}_phase_duration_seconds summary"]
+            for name, phase in report["phases"].items():
+                labels = format_labels([("phase", name)])
+                lines.append(f"{prefix}_phase_duration_seconds_count{labels} {phase['count']}")
+                lines.append(f"{prefix}_phase_duration_seconds_sum{labels} {format_value(phase['seconds'])}")
+
+        names = []
+        for entry in report["counts"]:
+            if entry["name"] not in names:
+                names.append(entry["name"])
+        for name in names:
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines += [f"{prefix}_{name}{format_labels(sorted(entry['labels'].items()))} {format_value(entry['value'])}"
+                      for entry in report["counts"] if entry["name"] == name]
+
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self, textfile=None, report_file=None):
+        """Write the OpenMetrics textfile and/or the JSON run report, replacing them atomically"""
+        if textfile:
+            write_atomic(textfile, self.openmetrics())
+        if report_file:
+            write_atomic(report_file, json.dumps(self.report(), indent=2) + "\n")
+
+
+def write_atomic(path, text):
+    # node_exporter may read the file at any time, never let it see a partial one
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temp, path)
@@ -0,0 +1,173 @@
+"""Compact in-memory model of exported guests, shared by the export and the import
+
+Snapshots and the export cache store guest records as plain JSON. In memory they are held as
+__slots__ dataclasses instead of nested dicts: repeated strings (node, type, status, OS type,
+disk and interface names) are interned, IP addresses are kept as ipaddress objects, and
+records with the same keys share one tuple of key names. from_dict() and to_dict() convert
+losslessly, including key order, missing keys and keys the model doesn't know about.
+"""
+
+import ipaddress
+import sys
+from dataclasses import dataclass
+
+_shapes = {}
+
+
+def shape(keys):
+    """Return a shared tuple of record keys, so records of the same shape don't each hold one"""
+    keys = tuple(keys)
+    return _shapes.setdefault(keys, keys)
+
+
+def pack_ip(value):
+    """Return an IP address string as an ipaddress object if that converts back to the same text"""
+    if not isinstance(value, str):
+        return value
+    try:
+        ip = ipaddress.ip_address(value)
+    except ValueError:
+        return value
+    return ip if str(ip) == value else value
+
+
+def unpack_ip(value):
+    return str(value) if isinstance(value, (ipaddress.IPv4Address, ipaddress.IPv6Address)) else value
+
+
+class Record:
+    """Conversion between JSON records and the model classes
+
+    Subclasses list their JSON keys in FIELDS (in the default order), the string fields worth
+    interning in INTERNED and converters for nested values in LOAD and DUMP. keys holds the
+    keys of the record the object was loaded from, extra the values of unknown keys.
+    """
+
+    __slots__ = ()
+    FIELDS = ()
+    INTERNED = ()
+    LOAD = {}
+    DUMP = {}
+    DEFAULT_KEYS = None
+
+    def __post_init__(self):
+        for name in self.INTERNED:
+            value = getattr(self, name)
+            if isinstance(value, str):
+                setattr(self, name, sys.intern(value))
+        if self.keys is None:
+            self.keys = self.DEFAULT_KEYS or shape(self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, data):
+        values = {}
+        extra = None
+        for key, value in data.items():
+            if key in cls.FIELDS:
+                load = cls.LOAD.get(key)
+                values[key] = load(value) if load else value
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        return cls(**values, keys=shape(data), extra=extra)
+
+    def to_dict(self):
+        record = {}
+        for key in self.keys:
+            if key in self.FIELDS:
+                dump = self.DUMP.get(key)
+                value = getattr(self, key)
+                record[key] = dump(value) if dump else value
+            else:
+                record[key] = self.extra[key]
+        return record
+
+
+@dataclass(slots=True)
+class IPAddress(Record):
+    ip: object = None
+    prefix: int = None
+    keys: tuple = None
+    extra: dict = None
+
+    FIELDS = ("ip", "prefix")
+    DUMP = {"ip": unpack_ip}
+
+    def __post_init__(self):
+        Record.__post_init__(self)
+        self.ip = pack_ip(self.ip)
+
+
+@dataclass(slots=True)
+class Disk(Record):
+    name: str = None
+    size_gb: float = None
+    description: str = None
+    keys: tuple = None
+    extra: dict = None
+
+    FIELDS = ("name", "size_gb", "description")
+    INTERNED = ("name",)
+
+
+@dataclass(slots=True)
+class Interface(Record):
+    name: str = None
+    mac: str = None
+    ip_addresses: list = None
+    keys: tuple = None
+    extra: dict = None
+
+    FIELDS = ("name", "mac", "ip_addresses")
+    INTERNED = ("name",)
+    LOAD = {"ip_addresses": lambda ips: [IPAddress.from_dict(ip) for ip in ips]}
+    DUMP = {"ip_addresses": lambda ips: [ip.to_dict() for ip in ips]}
+
+
+@dataclass(slots=True)
+class Guest(Record):
+    """One exported guest; offline guests only have name, type, status and host
+
+    cluster and cluster_id are only set in multi-cluster snapshots (proxmox_export.py --clusters).
+    """
+
+    name: str = None
+    type: str = None
+    status: str = None
+    ostype: str = None
+    vcpu: int = None
+    ram_mb: int = None
+    disks: list = None
+    interfaces: list = None
+    host: str = None
+    hash: str = None
+    change: str = None
+    keys: tuple = None
+    cluster: str = None
+    cluster_id: int = None
+    extra: dict = None
+
+    FIELDS = ("name", "type", "status", "ostype", "vcpu", "ram_mb", "disks", "interfaces", "host", "hash", "change",
+              "cluster", "cluster_id")
+    INTERNED = ("type", "status", "ostype", "host", "change", "cluster")
+    LOAD = {
+        "disks": lambda disks: [Disk.from_dict(disk) for disk in disks],
+        "interfaces": lambda interfaces: [Interface.from_dict(interface) for interface in interfaces],
+    }
+    DUMP = {
+        "disks": lambda disks: [disk.to_dict() for disk in disks],
+        "interfaces": lambda interfaces: [interface.to_dict() for interface in interfaces],
+    }
+    RUNNING_KEYS = shape(("name", "type", "status", "ostype", "vcpu", "ram_mb", "disks", "interfaces", "host"))
+    OFFLINE_KEYS = shape(("name", "type", "status", "host"))
+    DEFAULT_KEYS = RUNNING_KEYS
+
+    def to_dict(self):
+        record = Record.to_dict(self)
+        # hash and change are often set after loading, emit them even if the source lacked them
+        for key in ("hash", "change"):
+            value = getattr(self, key)
+            if value is not None and key not in record:
+                record[key] = value
+        return record
@@ -1,11 +1,31 @@
 #!/usr/bin/env python3
 
+import argparse
+import glob
+import hashlib
+import ipaddress
 import json
 import os
+import random
+import re
+import sqlite3
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import requests
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode, urlparse
 from dotenv import load_dotenv
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
+from metrics import Metrics
+import profiling
+from requests.adapters import HTTPAdapter
+from snapshot import SnapshotError, read_guests, read_snapshot, record_hash
+from requests.packages.urllib3.exceptions import ConnectTimeoutError, InsecureRequestWarning, NewConnectionError
 
 load_dotenv()
 
@@ -17,47 +37,536 @@ NETBOX_URL = os.getenv('NETBOX_URL', 'https://netbox.example.com')
 NETBOX_TOKEN = os.getenv('NETBOX_TOKEN')
 CLUSTER_ID = os.getenv('CLUSTER_ID')
 VERIFY_SSL = os.getenv('VERIFY_SSL', 'true').lower() == 'true'
+PAGE_SIZE = int(os.getenv('NETBOX_PAGE_SIZE', '1000'))
+PREFETCH_CHUNK_SIZE = 100  # VM IDs per filtered list request
+BATCH_SIZE = int(os.getenv('NETBOX_BATCH_SIZE', '100'))
+WORKERS = int(os.getenv('NETBOX_WORKERS', '4'))  # initial concurrent requests, adjusted to NetBox's latency
+MAX_WORKERS = max(WORKERS, int(os.getenv('NETBOX_MAX_WORKERS', '16')))
+LATENCY_TOLERANCE = float(os.getenv('NETBOX_LATENCY_TOLERANCE', '2.0'))  # p95 / baseline latency seen as congestion
+VRF_ID = os.getenv('VRF_ID')  # VRF of imported IP addresses, global table when unset
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', '1000'))  # snapshot records applied per flush
+IMPORT_JOURNAL_FILE = os.getenv('IMPORT_JOURNAL_FILE')  # SQLite journal of imported guests, disabled when unset
+IMPORT_CHECKPOINT = os.getenv('IMPORT_CHECKPOINT', 'true').lower() == 'true'  # checkpoint file next to the snapshot
+POOL_SIZE = int(os.getenv('NETBOX_POOL_SIZE', str(max(10, MAX_WORKERS))))
+CONNECT_TIMEOUT = float(os.getenv('NETBOX_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT = float(os.getenv('NETBOX_READ_TIMEOUT', '60'))
+RETRIES = int(os.getenv('NETBOX_RETRIES', '5'))
+BACKOFF = float(os.getenv('NETBOX_BACKOFF', '0.5'))  # base delay in seconds between retries
+STATE_LOADER = os.getenv('NETBOX_STATE_LOADER', 'rest').lower()  # 'rest' or 'graphql'
+IMPORT_METRICS_FILE = os.getenv('IMPORT_METRICS_FILE')  # OpenMetrics textfile written after each run
+IMPORT_REPORT_FILE = os.getenv('IMPORT_REPORT_FILE')  # JSON run report written after each run
 
 if not NETBOX_TOKEN:
     print("ERROR: NETBOX_TOKEN environment variable is required")
     sys.exit(1)
 
-if not CLUSTER_ID:
-    print("ERROR: CLUSTER_ID environment variable is required")
-    sys.exit(1)
+class AdaptiveLimiter:
+    """Limit on concurrent NetBox requests, adjusted with AIMD to what NetBox can handle"""
 
-headers = {
-    'Authorization': f'Token {NETBOX_TOKEN}',
-    'Content-Type': 'application/json',
-    'Accept': 'application/json'
-}
+    MIN_WINDOW = 10
+    ERROR_DECREASE = 0.5
+    LATENCY_DECREASE = 0.9
+    BASELINE_DRIFT = 0.02  # lets the baseline slowly follow lasting latency increases
+
+    def __init__(self, initial=WORKERS, maximum=MAX_WORKERS, tolerance=LATENCY_TOLERANCE):
+        self.maximum = max(1, maximum)
+        self.limit = float(min(max(1, initial), self.maximum))
+        self.tolerance = tolerance
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.baselines = {}
+        self.latencies = {}
+        self.completed = 0
+        self.saturated = False
+        self.decreased = False
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            if self.in_flight >= int(self.limit):
+                self.saturated = True
+
+    def release(self, kind, latency, overloaded=False):
+        """Return a slot, reporting the request's latency and whether NetBox was overloaded"""
+        with self.condition:
+            self.in_flight -= 1
+            self.completed += 1
+            if overloaded:
+                # 429, 5xx, timeouts and connection errors halve the limit, once per window so a
+                # burst of errors counts once
+                if not self.decreased:
+                    self._set_limit(self.limit * self.ERROR_DECREASE, "NetBox overloaded")
+                    self.decreased = True
+            else:
+                self.latencies.setdefault(kind, []).append(latency)
+
+            if self.completed >= max(self.MIN_WINDOW, int(self.limit)):
+                self._end_window()
+            self.condition.notify_all()
+
+    def _end_window(self):
+        # Latencies are compared to a baseline per kind of request, its lowest median per window.
+        # A p95 ratio above the tolerance means NetBox is queueing requests, the limit shrinks;
+        # a window that used the whole limit without either sign of overload grows it by one.
+        ratios = []
+        for kind, latencies in self.latencies.items():
+            latencies.sort()
+            median = latencies[len(latencies) // 2]
+            baseline = self.baselines.get(kind)
+            if baseline:
+                ratios.extend(latency / baseline for latency in latencies)
+                median = min(median, baseline + (median - baseline) * self.BASELINE_DRIFT)
+            self.baselines[kind] = median
+        ratios.sort()
+        p95 = ratios[int(0.95 * (len(ratios) - 1))] if ratios else 1.0
+
+        if self.decreased:
+            pass
+        elif p95 > self.tolerance:
+            self._set_limit(self.limit * self.LATENCY_DECREASE, f"p95 latency {p95:.1f}x baseline")
+        elif self.saturated and self.limit < self.maximum:
+            self._set_limit(self.limit + 1, f"p95 latency {p95:.1f}x baseline")
+        self.latencies = {}
+        self.completed = 0
+        self.saturated = self.decreased = False
+
+    def _set_limit(self, limit, reason):
+        old = int(self.limit)
+        self.limit = min(float(self.maximum), max(1.0, limit))
+        if int(self.limit) != old:
+            print(f"INFO: NetBox concurrency limit {old} -> {int(self.limit)} ({reason})")
+
+class OutcomeUnknown(Exception):
+    """A POST failed after it was sent, NetBox may or may not have created the objects"""
+
+class NetBoxError(Exception):
+    """A request NetBox rejected (status is its HTTP status) or that never reached it (status is None)"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class NetBoxClient:
+    """NetBox REST API client with a pooled session, timeouts and retries"""
+
+    # Statuses NetBox or its proxy return while overloaded or restarting
+    RETRY_STATUSES = {429, 502, 503, 504}
+    # POSTs are only retried when NetBox can't have processed them
+    POST_RETRY_STATUSES = {429, 503}
+    # Statuses a POST may have been committed with, e.g. a proxy timing out while NetBox works
+    POST_UNKNOWN_STATUSES = {500, 502, 504}
+    MAX_BACKOFF = 60
+
+    def __init__(self, url, token, verify_ssl=True, pool_size=POOL_SIZE, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                 retries=RETRIES, backoff=BACKOFF, limiter=None, metrics=None):
+        parsed = urlparse(url)
+        self.limiter = limiter or AdaptiveLimiter()
+        self.metrics = metrics
+        self.origin = f"{parsed.scheme}://{parsed.netloc}"
+        self.base_url = f"{url.rstrip('/')}/api/"
+        self.graphql_url = f"{url.rstrip('/')}/graphql/"
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        self.session.verify = verify_ssl
+        self.session.headers.update({
+            'Authorization': f'Token {token}',
+            'Content-Type': 'application/json',
+            'Accept': 'application/json'
+        })
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, endpoint, data=None, idempotent=None, raise_errors=False):
+        """Send a request and return the decoded response, or None (NetBoxError with raise_errors) on failure"""
+        url = endpoint if endpoint.startswith(('http://', 'https://')) else self.base_url + endpoint
+        # POSTs create objects unless the caller knows better, e.g. a read-only GraphQL query
+        if idempotent is None:
+            idempotent = method != 'POST'
+        retry_statuses = self.RETRY_STATUSES if idempotent else self.POST_RETRY_STATUSES
+        kind = self._request_kind(method, url, data)
+
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            start = time.monotonic()
+            response = error = None
+            try:
+                response = self.session.request(method, url, json=data, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                error = e
+            finally:
+                # The slot is returned whatever happened, later requests would wait for it forever otherwise
+                latency = time.monotonic() - start
+                self.limiter.release(kind, latency, overloaded=response is None or response.status_code == 429
+                                     or response.status_code >= 500)
+
+            if error is not None:
+                if self.metrics:
+                    self.metrics.observe_request(method, kind[1], latency, error=True)
+                profiling.tracer.add(f"{method} {kind[1]}", 'request', start, start + latency,
+                                     {'attempt': attempt, 'error': str(error)})
+                # A POST that failed once it was sent may still have created the objects, don't
+                # send them twice
+                if not idempotent and self._maybe_sent(error):
+                    raise OutcomeUnknown(f"{method} {endpoint} failed, NetBox may have processed it: {error}") \
+                        from error
+                if attempt == self.retries:
+                    if raise_errors:
+                        raise NetBoxError(str(error)) from error
+                    print(f"ERROR: NetBox API request failed: {error}")
+                    return None
+                delay = self._backoff_delay(attempt)
+                print(f"WARN: NetBox request {method} {endpoint} failed ({error}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            if self.metrics:
+                self.metrics.observe_request(method, kind[1], latency, error=response.status_code >= 400)
+            if profiling.tracer.enabled:
+                span_args = {'attempt': attempt, 'status': response.status_code}
+                if kind[2] is not None:
+                    span_args['objects'] = len(data)
+                profiling.tracer.add(f"{method} {kind[1]}", 'request', start, start + latency, span_args)
+
+            if response.status_code in retry_statuses and attempt < self.retries:
+                delay = self._retry_after(response)
+                if delay is None:
+                    delay = self._backoff_delay(attempt)
+                print(f"WARN: NetBox returned {response.status_code} for {method} {endpoint}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+
+            try:
+                response.raise_for_status()
+            except requests.exceptions.HTTPError as e:
+                if not idempotent and response.status_code in self.POST_UNKNOWN_STATUSES:
+                    raise OutcomeUnknown(f"{method} {endpoint} returned {response.status_code}, "
+                                         f"NetBox may have processed it") from e
+                if raise_errors:
+                    raise NetBoxError(f"{e}: {response.text}", response.status_code) from e
+                print(f"ERROR: NetBox API request failed: {e}")
+                print(f"Response: {response.text}")
+                return None
+            if not response.content:
+                return None
+            try:
+                return response.json()
+            except ValueError as e:
+                # e.g. a proxy's HTML page; a POST that got this far was processed
+                if not idempotent:
+                    raise OutcomeUnknown(f"{method} {endpoint} returned no JSON, NetBox may have processed it: {e}") \
+                        from e
+                print(f"ERROR: NetBox returned an invalid response for {method} {endpoint}: {e}")
+                return None
+
+    def list(self, endpoint, params=None):
+        """Fetch every object from a paginated list endpoint by following NetBox's next links"""
+        query = dict(params or {})
+        query.setdefault('limit', PAGE_SIZE)
+        url = f'{endpoint}?{urlencode(query, doseq=True)}'
+        results = []
+
+        while url:
+            page = self.request('GET', url)
+            if page is None:
+                return None
+            results.extend(page['results'])
+            url = page.get('next')
+            if url:
+                # NetBox builds next links from its own idea of the hostname, keep ours
+                next_url = urlparse(url)
+                url = f"{self.origin}{next_url.path}?{next_url.query}"
+        return results
+
+    def graphql(self, query, variables=None):
+        """Run a GraphQL query and return its data, or None if the request or the query failed"""
+        # Queries only read, so they are retried like GETs
+        response = self.request('POST', self.graphql_url, {'query': query, 'variables': variables or {}},
+                                idempotent=True)
+        if response is None:
+            return None
+        if response.get('errors'):
+            messages = '; '.join(error.get('message', str(error)) for error in response['errors'])
+            print(f"ERROR: NetBox GraphQL query failed: {messages}")
+            return None
+        return response.get('data')
+
+    @staticmethod
+    def _maybe_sent(error):
+        """Return False if a request failed before its body could have reached NetBox"""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return False
+        if isinstance(error, requests.exceptions.ConnectionError):
+            # Failed connects are wrapped as MaxRetryError(reason=...), drops after sending are not
+            reason = getattr(error.args[0], 'reason', None) if error.args else None
+            return not isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+        return isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError))
+
+    @staticmethod
+    def _request_kind(method, url, data):
+        """Group requests with comparable latency: method, endpoint without IDs, bulk batch size or None"""
+        path = re.sub(r'/\d+/', '/', urlparse(url).path)
+        # Bulk writes take time per object, batches are grouped by power of two so a baseline
+        # set by small batches doesn't make full ones look slow
+        return method, path, len(data).bit_length() if isinstance(data, list) else None
+
+    def _backoff_delay(self, attempt):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.MAX_BACKOFF, self.backoff * 2 ** attempt))
+
+    def _retry_after(self, response):
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                return None
+        return min(self.MAX_BACKOFF, max(0.0, delay))
+
+metrics = Metrics('netbox_import')
+netbox = NetBoxClient(NETBOX_URL, NETBOX_TOKEN, VERIFY_SSL, metrics=metrics)
 
 def netbox_request(method, endpoint, data=None):
     """Make a request to NetBox API"""
-    url = f"{NETBOX_URL}/api/{endpoint}"
+    return netbox.request(method, endpoint, data)
 
-    try:
-        if method == 'GET':
-            response = requests.get(url, headers=headers, verify=VERIFY_SSL)
-        elif method == 'POST':
-            response = requests.post(url, headers=headers, json=data, verify=VERIFY_SSL)
-        elif method == 'PATCH':
-            response = requests.patch(url, headers=headers, json=data, verify=VERIFY_SSL)
-        elif method == 'PUT':
-            response = requests.put(url, headers=headers, json=data, verify=VERIFY_SSL)
-        elif method == 'DELETE':
-            response = requests.delete(url, headers=headers, verify=VERIFY_SSL)
-
-        response.raise_for_status()
-        return response.json() if response.content else None
-    except requests.exceptions.RequestException as e:
-        print(f"ERROR: NetBox API request failed: {e}")
-        if hasattr(e.response, 'text'):
-            print(f"Response: {e.response.text}")
+def netbox_list(endpoint, params=None):
+    """Fetch every object from a paginated NetBox list endpoint"""
+    return netbox.list(endpoint, params)
+
+# In-memory view of the cluster's NetBox objects, filled by prefetch_cluster_state()
+netbox_state = {
+    'vms': {},          # VM name -> VM
+    'disks': {},        # (VM ID, disk name) -> virtual disk
+    'interfaces': {},   # (VM ID, interface name) -> VM interface
+    'vm_ids': set(),    # VMs whose disks and interfaces are fully indexed
+    'all_vms': False,   # every VM of the cluster is indexed
+    'vm_names': set(),  # names whose VMs are indexed if they exist, after a prefetch of some names
+    'platforms': {},    # platform name -> platform ID
+}
+
+class AddressIndex:
+    """In-memory index of NetBox IP and MAC addresses, so lookups need no HTTP requests"""
+
+    IP_FIELDS = 'id,address,vrf,status,assigned_object_type,assigned_object_id'
+    MAC_FIELDS = 'id,mac_address,assigned_object_type,assigned_object_id'
+
+    def __init__(self, vrf_id=None):
+        self.vrf_id = int(vrf_id) if vrf_id else None
+        self.ips = {}
+        self.macs = {}
+        self.loaded = False
+
+    def load(self):
+        """Read all IPs of the VRF and all MACs with paginated list requests"""
+        ips = netbox_list('ipam/ip-addresses/', {'vrf_id': self.vrf_id or 'null', 'fields': self.IP_FIELDS})
+        macs = netbox_list('dcim/mac-addresses/', {'fields': self.MAC_FIELDS})
+        if ips is None or macs is None:
+            print("WARN: Loading IP and MAC addresses failed, falling back to per-address lookups")
+            return False
+
+        self.ips, self.macs = {}, {}
+        for ip in ips:
+            self.add_ip(ip)
+        for mac in macs:
+            self.add_mac(mac)
+        self.loaded = True
+        print(f"INFO: Indexed {len(self.ips)} IP addresses and {len(self.macs)} MAC addresses")
+        return True
+
+    @staticmethod
+    def ip_key(vrf_id, address):
+        # VRF ID (None for the global table) and parsed host address, so different spellings of
+        # the same IPv6 address match and equal IPs in other VRFs don't
+        return vrf_id, ipaddress.ip_interface(address).ip
+
+    def add_ip(self, ip):
+        vrf = ip.get('vrf')
+        vrf_id = vrf['id'] if isinstance(vrf, dict) else vrf
+        try:
+            self.ips[self.ip_key(vrf_id, ip['address'])] = ip
+        except ValueError:
+            print(f"WARN: Ignoring invalid IP address in NetBox: {ip['address']}")
+
+    def add_mac(self, mac):
+        self.macs[mac['mac_address'].lower()] = mac
+
+    def find_ip(self, address):
+        key = self.ip_key(self.vrf_id, address)
+        if key in self.ips or self.loaded:
+            return self.ips.get(key)
+
+        # Until load() succeeded, a miss has to be checked with NetBox
+        params = {'address': address, 'vrf_id': self.vrf_id or 'null'}
+        existing = netbox_request('GET', f'ipam/ip-addresses/?{urlencode(params)}')
+        if existing and existing['results']:
+            self.add_ip(existing['results'][0])
+            return existing['results'][0]
+        return None
+
+    def find_mac(self, mac_address):
+        mac = self.macs.get(mac_address.lower())
+        if mac or self.loaded:
+            return mac
+
+        existing = netbox_request('GET', f'dcim/mac-addresses/?{urlencode({"mac_address": mac_address})}')
+        if existing and existing['results']:
+            self.add_mac(existing['results'][0])
+            return existing['results'][0]
+        return None
+
+address_index = AddressIndex(VRF_ID)
+
+# Cluster VMs with their disks and interfaces, one page of VMs per query
+CLUSTER_STATE_QUERY = """
+query ClusterState($cluster_id: ID!, $offset: Int!, $limit: Int!) {
+  virtual_machine_list(filters: {cluster_id: $cluster_id}, pagination: {offset: $offset, limit: $limit}) {
+    id name status vcpus memory comments
+    cluster { id }
+    platform { id }
+    virtualdisks { id name size description }
+    interfaces { id name }
+  }
+}
+"""
+
+def list_chunked(endpoint, params, key, values):
+    """Fetch a list endpoint filtered by PREFETCH_CHUNK_SIZE values of key at a time, None on failure"""
+    results = []
+    for i in range(0, len(values), PREFETCH_CHUNK_SIZE):
+        chunk = netbox_list(endpoint, dict(params, **{key: values[i:i + PREFETCH_CHUNK_SIZE]}))
+        if chunk is None:
+            return None
+        results.extend(chunk)
+    return results
+
+# Left out of VM lookups: the config context is rendered per VM and is the bulk of the response,
+# while the import never reads it
+VM_EXCLUDE = 'config_context'
+
+def load_cluster_state_rest(names=None):
+    """Return the cluster's VMs, disks and interfaces from REST list requests, or None on failure
+
+    With names, only the VMs of those names and their disks and interfaces are fetched.
+    """
+    if names is None:
+        vms = netbox_list('virtualization/virtual-machines/', {'cluster_id': CLUSTER_ID, 'exclude': VM_EXCLUDE})
+    else:
+        vms = list_chunked('virtualization/virtual-machines/', {'cluster_id': CLUSTER_ID, 'exclude': VM_EXCLUDE},
+                           'name', sorted(names))
+    if vms is None:
+        return None
+
+    vm_ids = [vm['id'] for vm in vms]
+    if names is None:
+        interfaces = netbox_list('virtualization/interfaces/', {'cluster_id': CLUSTER_ID})
+    else:
+        interfaces = list_chunked('virtualization/interfaces/', {}, 'virtual_machine_id', vm_ids)
+    if interfaces is None:
         return None
+    disks = list_chunked('virtualization/virtual-disks/', {}, 'virtual_machine_id', vm_ids)
+    if disks is None:
+        return None
+    return vms, disks, interfaces
+
+def graphql_ref(obj):
+    """Convert a nested GraphQL object to the {'id': ...} shape of the REST API"""
+    return {'id': int(obj['id'])} if obj else None
+
+def load_cluster_state_graphql():
+    """Return the cluster's VMs, disks and interfaces from paged GraphQL queries in REST shape, or None on failure"""
+    vms, disks, interfaces = [], [], []
+    offset = 0
+    while True:
+        data = netbox.graphql(CLUSTER_STATE_QUERY, {'cluster_id': str(CLUSTER_ID), 'offset': offset, 'limit': PAGE_SIZE})
+        if data is None:
+            return None
+        page = data['virtual_machine_list']
+        for vm in page:
+            vm_ref = graphql_ref(vm)
+            vms.append({
+                'id': vm_ref['id'],
+                'name': vm['name'],
+                'status': {'value': vm['status'].lower()} if vm.get('status') else None,
+                'vcpus': float(vm['vcpus']) if vm.get('vcpus') is not None else None,
+                'memory': vm.get('memory'),
+                'comments': vm.get('comments', ''),
+                'cluster': graphql_ref(vm.get('cluster')),
+                'platform': graphql_ref(vm.get('platform')),
+            })
+            for disk in vm.get('virtualdisks') or []:
+                disks.append(dict(disk, id=int(disk['id']), virtual_machine=vm_ref))
+            for interface in vm.get('interfaces') or []:
+                interfaces.append(dict(interface, id=int(interface['id']), virtual_machine=vm_ref))
+        if len(page) < PAGE_SIZE:
+            return vms, disks, interfaces
+        offset += PAGE_SIZE
+
+def prefetch_cluster_state(names=None):
+    """Load the cluster's VMs, disks and interfaces (only those of names if given) and index all IPs and MACs"""
+    state = None
+    if STATE_LOADER == 'graphql':
+        state = load_cluster_state_graphql()
+        if state is None:
+            print("WARN: GraphQL prefetch failed, falling back to REST")
+        elif names is not None:
+            vms, disks, interfaces = state
+            vms = [vm for vm in vms if vm['name'] in names]
+            vm_ids = {vm['id'] for vm in vms}
+            state = (vms, [d for d in disks if d['virtual_machine']['id'] in vm_ids],
+                     [i for i in interfaces if i['virtual_machine']['id'] in vm_ids])
+    if state is None:
+        state = load_cluster_state_rest(names)
+    if state is None:
+        print("WARN: Prefetch failed, falling back to per-object lookups")
+        netbox_state['all_vms'] = False
+        netbox_state['vm_names'] = set()
+        return False
+
+    vms, disks, interfaces = state
+    netbox_state['vms'] = {vm['name']: vm for vm in vms}
+    netbox_state['disks'] = {(d['virtual_machine']['id'], d['name']): d for d in disks}
+    netbox_state['interfaces'] = {(i['virtual_machine']['id'], i['name']): i for i in interfaces}
+    netbox_state['vm_ids'] = {vm['id'] for vm in vms}
+    netbox_state['all_vms'] = names is None
+    netbox_state['vm_names'] = set(names or ())
+
+    print(f"INFO: Prefetched {len(vms)} VMs, {len(disks)} disks and {len(interfaces)} interfaces "
+          f"from cluster {CLUSTER_ID}")
+    return address_index.load()
+
+def find_existing(index, key, endpoint, params):
+    """Look up a VM, disk or interface in netbox_state, querying NetBox when the index can't be trusted"""
+    obj = netbox_state[index].get(key)
+    if obj:
+        return obj
+    # Disks and interfaces of prefetched VMs are complete, a miss means the object doesn't exist
+    if index in ('disks', 'interfaces') and key[0] in netbox_state['vm_ids']:
+        return None
+    # So are the cluster's VMs after a full prefetch, or those of the prefetched names
+    if index == 'vms' and (netbox_state['all_vms'] or key in netbox_state['vm_names']):
+        return None
+
+    existing = netbox_request('GET', f'{endpoint}?{urlencode(params)}')
+    if existing and existing['results']:
+        obj = existing['results'][0]
+        netbox_state[index][key] = obj
+        return obj
+    return None
 
 def verify_cluster():
     """Verify that the cluster ID exists"""
+    if not CLUSTER_ID:
+        print("ERROR: CLUSTER_ID environment variable is required")
+        return False
     cluster = netbox_request('GET', f'virtualization/clusters/{CLUSTER_ID}/')
     if cluster:
         print(f"INFO: Using cluster: {cluster['name']} (ID: {CLUSTER_ID})")
@@ -68,11 +577,15 @@ def verify_cluster():
 
 def get_or_create_platform(platform_name):
     """Get or create a platform in NetBox"""
+    if platform_name in netbox_state['platforms']:
+        return netbox_state['platforms'][platform_name]
+
     # First, try to find existing platform
-    platforms = netbox_request('GET', f'dcim/platforms/?name={platform_name}')
+    platforms = netbox_request('GET', f'dcim/platforms/?{urlencode({"name": platform_name})}')
     if platforms and platforms['results']:
         platform_id = platforms['results'][0]['id']
         print(f"INFO: Found existing platform: {platform_name} (ID: {platform_id})")
+        netbox_state['platforms'][platform_name] = platform_id
         return platform_id
 
     # If platform doesn't exist, create it
@@ -81,70 +594,398 @@ def get_or_create_platform(platform_name):
         'slug': platform_name.lower()
     }
 
-    platform = netbox_request('POST', 'dcim/platforms/', platform_data)
+    try:
+        platform = netbox_request('POST', 'dcim/platforms/', platform_data)
+    except OutcomeUnknown as e:
+        print(f"WARN: {e}")
+        platform = None
+    if not platform:
+        # Another import running in parallel, or the timed out POST, may have created it
+        platforms = netbox_request('GET', f'dcim/platforms/?{urlencode({"name": platform_name})}')
+        if platforms and platforms['results']:
+            platform_id = platforms['results'][0]['id']
+            print(f"INFO: Found existing platform: {platform_name} (ID: {platform_id})")
+            netbox_state['platforms'][platform_name] = platform_id
+            return platform_id
     if platform:
         platform_id = platform['id']
         print(f"INFO: Created platform: {platform_name} (ID: {platform_id})")
+        netbox_state['platforms'][platform_name] = platform_id
         return platform_id
     else:
         print(f"ERROR: Failed to create platform: {platform_name}")
         return None
 
+class BulkWriter:
+    """Schedule creates and updates as NetBox bulk requests on a bounded worker pool"""
+
+    def __init__(self, batch_size=BATCH_SIZE, workers=MAX_WORKERS):
+        self.batch_size = max(1, batch_size)
+        self.workers = max(1, workers)
+        self.pending = {}   # (method, endpoint) -> [(seq, payload, callback, key)]
+        self.claims = {}    # key of an object being created -> callbacks waiting for it
+        self.seq = 0
+
+    def queue(self, method, endpoint, payload, callback=None, key=None):
+        """Queue a POST or PATCH; callback receives the resulting object or None"""
+        if method == 'POST' and key is not None:
+            self.claims[key] = []
+        self.pending.setdefault((method, endpoint), []).append((self.seq, payload, callback, key))
+        self.seq += 1
+
+    def wait_for(self, key, retry):
+        """Defer retry until a queued create for key has finished, returns False if none is queued"""
+        if key not in self.claims:
+            return False
+        self.claims[key].append(retry)
+        return True
+
+    def flush(self):
+        """Send all queued writes, including the ones queued by callbacks of earlier batches"""
+        # Children (disks, interfaces, then MACs and IPs) are only queued by their parent's
+        # callback, once its ID exists. The client's AdaptiveLimiter decides how many of the
+        # workers' requests run at once. Callbacks run on this thread, so they can safely
+        # update netbox_state and queue further objects.
+        with metrics.phase('write'), ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='netbox-write') as pool:
+            in_flight = {}
+            while self.pending or in_flight:
+                while self.pending and len(in_flight) < self.workers:
+                    method, endpoint, batch = self._next_batch()
+                    future = pool.submit(self._send, method, endpoint, [op[1] for op in batch])
+                    in_flight[future] = batch
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._deliver(in_flight.pop(future), future.result())
+
+    def _next_batch(self):
+        # Serve the group holding the longest waiting object first, so children start as soon
+        # as a worker is free while parents queued earlier still go out in full batches
+        method, endpoint = min(self.pending, key=lambda group: self.pending[group][0][0])
+        ops = self.pending[(method, endpoint)]
+        batch, rest = ops[:self.batch_size], ops[self.batch_size:]
+        if rest:
+            self.pending[(method, endpoint)] = rest
+        else:
+            del self.pending[(method, endpoint)]
+        return method, endpoint, batch
+
+    def _send(self, method, endpoint, payloads):
+        try:
+            with profiling.tracer.span(f"{method} {endpoint}", 'write', objects=len(payloads)):
+                results = netbox.request(method, endpoint, payloads, raise_errors=True)
+        except OutcomeUnknown as e:
+            # Sending the objects again could create them twice, they are failed for this run and
+            # found by the prefetch of the next one
+            print(f"ERROR: {e}")
+            return [None] * len(payloads)
+        except NetBoxError as e:
+            if len(payloads) > 1 and e.status is not None and 400 <= e.status < 500:
+                # NetBox rejects the whole batch when one object is invalid, retry them one by one
+                print(f"WARN: Bulk {method} to {endpoint} rejected, retrying {len(payloads)} objects individually")
+                return [self._send(method, endpoint, [payload])[0] for payload in payloads]
+            print(f"ERROR: {method} to {endpoint} failed: {e}")
+            return [None] * len(payloads)
+        except Exception as e:
+            print(f"ERROR: {method} to {endpoint} failed: {e}")
+            return [None] * len(payloads)
+
+        if isinstance(results, list) and len(results) == len(payloads):
+            return results
+        print(f"ERROR: Unexpected response to {method} {endpoint}")
+        return [None] * len(payloads)
+
+    def _deliver(self, batch, results):
+        # A failed parent never calls back with an ID, so its subtree is skipped on its own
+        for (_, _, callback, key), result in zip(batch, results):
+            if callback:
+                callback(result)
+            for retry in self.claims.pop(key, []) if key is not None else []:
+                retry()
+
+import_stats = Counter()
+
+# Object kinds in the order they are reported in the summary
+OBJECT_KINDS = [('vm', 'VMs'), ('disk', 'disks'), ('interface', 'interfaces'), ('mac', 'MACs'), ('ip', 'IPs')]
+
+def normalize_value(field, value):
+    """Bring a payload value and the matching NetBox API value into a comparable form"""
+    if isinstance(value, dict):
+        # Nested objects compare by ID, choice fields by their value
+        if 'id' in value:
+            return value['id']
+        if 'value' in value:
+            return value['value']
+    if value is None:
+        return ''
+    if field == 'mac_address':
+        return str(value).lower()
+    if field == 'address':
+        try:
+            return str(ipaddress.ip_interface(value))
+        except ValueError:
+            return str(value).lower()
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+def diff_payload(payload, existing):
+    """Return the payload fields that differ from the existing object, skipping fields it doesn't carry"""
+    return {
+        field: value for field, value in payload.items()
+        if field in existing and normalize_value(field, value) != normalize_value(field, existing[field])
+    }
+
+def save_object(writer, kind, label, endpoint, payload, existing, on_saved=None, key=None, create_fields=None,
+                guest=None):
+    """Create an object or PATCH only the fields that changed, skipping the request when nothing did
+
+    The outcome is also recorded in guest, the GuestImport of the guest the object belongs to.
+    """
+    if existing:
+        changes = diff_payload(payload, existing)
+        if not changes:
+            print(f"INFO: Unchanged {label}")
+            import_stats[(kind, 'unchanged')] += 1
+            if guest:
+                guest.saved(kind, existing, 'unchanged', label)
+            if on_saved:
+                on_saved(existing)
+            return
+        method, outcome = 'PATCH', 'updated'
+        payload = dict(changes, id=existing['id'])
+    else:
+        method, outcome = 'POST', 'created'
+        payload = dict(payload, **(create_fields or {}))
+
+    def on_result(obj):
+        if not obj:
+            print(f"ERROR: Failed to {'create' if method == 'POST' else 'update'} {label}")
+            import_stats[(kind, 'failed')] += 1
+            if guest:
+                guest.failed = True
+            return
+        print(f"INFO: {outcome.capitalize()} {label}")
+        import_stats[(kind, outcome)] += 1
+        if guest:
+            guest.saved(kind, obj, outcome, label)
+        if on_saved:
+            on_saved(obj)
+
+    writer.queue(method, endpoint, payload, on_result, key if method == 'POST' else None)
+
+def print_summary():
+    """Print created/updated/unchanged counts per object kind"""
+    for kind, title in OBJECT_KINDS:
+        counts = {outcome: import_stats[(kind, outcome)] for outcome in ('created', 'updated', 'unchanged', 'failed')}
+        print(f"INFO: {title}: {counts['created']} created, {counts['updated']} updated, "
+              f"{counts['unchanged']} unchanged, {counts['failed']} failed")
+
+class GuestImport:
+    """NetBox objects saved for one guest during the import, and whether any of them failed"""
+
+    def __init__(self, name, content_hash, checkpoint=None):
+        self.name = name
+        self.hash = content_hash
+        self.ids = {}   # object kind -> NetBox IDs
+        self.failed = False
+        self.checkpoint = checkpoint
+
+    def saved(self, kind, obj, outcome=None, label=None):
+        self.ids.setdefault(kind, []).append(obj['id'])
+        if self.checkpoint:
+            self.checkpoint.object_saved(self, kind, label, obj['id'], outcome)
+
+class ImportJournal:
+    """SQLite journal, per cluster, of the content hash and NetBox IDs last applied successfully per guest"""
+
+    def __init__(self, path, cluster_id=None):
+        # Parallel shards share the file, wait for each other's commits
+        self.db = sqlite3.connect(path, timeout=60)
+        self.cluster_id = str(cluster_id or CLUSTER_ID)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS guests ("
+            "cluster_id TEXT, name TEXT, hash TEXT, ids TEXT, applied_at REAL, "
+            "PRIMARY KEY (cluster_id, name))"
+        )
+
+    def get(self, name):
+        row = self.db.execute(
+            "SELECT hash, ids FROM guests WHERE cluster_id = ? AND name = ?", (self.cluster_id, name)
+        ).fetchone()
+        if not row:
+            return None
+        return {'hash': row[0], 'ids': json.loads(row[1])}
+
+    def record(self, guest):
+        self.db.execute(
+            "INSERT OR REPLACE INTO guests VALUES (?, ?, ?, ?, ?)",
+            (self.cluster_id, guest.name, guest.hash, json.dumps(guest.ids), time.time())
+        )
+
+    def forget(self, name):
+        self.db.execute("DELETE FROM guests WHERE cluster_id = ? AND name = ?", (self.cluster_id, name))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+class ImportCheckpoint:
+    """Append-only JSON Lines log of saved objects and finished guests, so --resume can skip them"""
+
+    def __init__(self, path, cluster_id=None):
+        self.path = path
+        self.cluster_id = str(cluster_id or CLUSTER_ID)
+        self.done = {}  # guest name -> content hash
+        self.file = None
+
+    @staticmethod
+    def path_for(json_file, shard=None, cluster_id=None):
+        # One log per shard, and per cluster of a multi-cluster snapshot
+        path = f'{json_file}.checkpoint' + (f'.c{cluster_id}' if cluster_id else '')
+        return path + (f'.{shard[0]}-{shard[1]}' if shard else '')
+
+    @staticmethod
+    def existing(json_file, cluster_id=None):
+        """Return the checkpoint files of a snapshot (of one cluster's guests), those of all shards included"""
+        path = glob.escape(ImportCheckpoint.path_for(json_file, cluster_id=cluster_id))
+        return sorted(glob.glob(path) + glob.glob(path + '.*'))
+
+    def load(self, paths):
+        """Read the guests finished by earlier runs, ignoring logs of other clusters and torn lines"""
+        for path in paths:
+            with open(path, encoding='utf-8') as f:
+                for number, line in enumerate(f, 1):
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # An interrupted run may have died in the middle of a line
+                        print(f"WARN: Ignoring incomplete line {number} of {path}")
+                        continue
+                    if 'event' in entry:
+                        if entry.get('cluster_id') != self.cluster_id:
+                            print(f"WARN: Ignoring {path}, it belongs to cluster {entry.get('cluster_id')}")
+                            break
+                    elif entry.get('done'):
+                        self.done[entry['guest']] = entry['hash']
+        return len(self.done)
+
+    def open(self, resume=False):
+        # Line buffered, every line reaches the file when it is written
+        self.file = open(self.path, 'a' if resume else 'w', encoding='utf-8', buffering=1)
+        if resume and self.file.tell():
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read() != b'\n':
+                    # End the torn line, otherwise it would swallow the first line of this run
+                    self.file.write('\n')
+        self._write({'event': 'resume' if resume else 'start', 'cluster_id': self.cluster_id, 'at': round(time.time(), 3)})
+
+    def completed(self, name, content_hash):
+        return self.done.get(name) == content_hash
+
+    def object_saved(self, guest, kind, label, object_id, outcome):
+        self._write({'guest': guest.name, 'kind': kind, 'object': label, 'id': object_id, 'outcome': outcome})
+
+    def guest_done(self, guest):
+        # Only logged once all of the guest's objects were saved without errors
+        self._write({'guest': guest.name, 'done': True, 'hash': guest.hash, 'ids': guest.ids})
+
+    def close(self, finished=False):
+        if finished:
+            self._write({'event': 'finished', 'cluster_id': self.cluster_id, 'at': round(time.time(), 3)})
+        self.file.close()
+
+    def _write(self, entry):
+        self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+def open_checkpoint(json_file, shard=None, resume=False, cluster_id=None):
+    """Return the ImportCheckpoint of this run, or None when disabled or the file can't be written"""
+    if not IMPORT_CHECKPOINT:
+        return None
+    checkpoint = ImportCheckpoint(ImportCheckpoint.path_for(json_file, shard, cluster_id))
+    try:
+        if resume:
+            paths = ImportCheckpoint.existing(json_file, cluster_id)
+            if paths:
+                print(f"INFO: Resuming: {checkpoint.load(paths)} VMs were finished by the interrupted import")
+            else:
+                print(f"WARN: No checkpoint found for {json_file}, importing all VMs")
+        elif not shard:
+            # A fresh import discards the logs of earlier runs, a shard only truncates its own
+            remove_checkpoints(json_file, cluster_id)
+        checkpoint.open(resume)
+    except OSError as e:
+        print(f"WARN: Checkpoint {checkpoint.path} not available, the import can't be resumed: {e}")
+        return None
+    return checkpoint
+
+def remove_checkpoints(json_file, cluster_id=None):
+    for path in ImportCheckpoint.existing(json_file, cluster_id):
+        os.remove(path)
+
+def known_ids():
+    """Return the IDs of the cluster's NetBox objects by kind, as loaded by prefetch_cluster_state()"""
+    return {
+        'vm': netbox_state['vm_ids'],
+        'disk': {disk['id'] for disk in netbox_state['disks'].values()},
+        'interface': {interface['id'] for interface in netbox_state['interfaces'].values()},
+        'mac': {mac['id'] for mac in address_index.macs.values()},
+        'ip': {ip['id'] for ip in address_index.ips.values()},
+    }
+
+def journal_matches(entry, guest, current_ids):
+    """Return True if the guest's content was applied before and all its objects still exist in NetBox"""
+    if not entry or entry['hash'] != guest.hash or 'vm' not in entry['ids']:
+        return False
+    return all(set(ids) <= current_ids[kind] for kind, ids in entry['ids'].items())
+
 def check_existing_mac(mac_address):
     """Check if MAC address already exists in NetBox"""
-    existing_macs = netbox_request('GET', f'dcim/mac-addresses/?mac_address={mac_address}')
-    if existing_macs and existing_macs['results']:
-        mac_info = existing_macs['results'][0]
+    mac_info = address_index.find_mac(mac_address)
+    if mac_info:
         print(f"INFO: MAC {mac_address} already exists (ID: {mac_info['id']})")
         return mac_info
     return None
 
-def create_or_update_mac_address(mac_address, interface_id):
-    """Create or update MAC address assignment in NetBox"""
+@profiling.traced('import', lambda mac_address, interface_id, writer, guest=None: {'mac': mac_address})
+def create_or_update_mac_address(mac_address, interface_id, writer, guest=None):
+    """Queue creation or update of a MAC address assignment in NetBox"""
     if not mac_address:
-        return None
+        return
+
+    # Another interface is creating the same MAC in this batch, update it once it exists
+    key = ('macs', mac_address.lower())
+    if writer.wait_for(key, lambda: create_or_update_mac_address(mac_address, interface_id, writer, guest)):
+        return
 
     print(f"INFO: Processing MAC address: {mac_address}")
 
-    # Check if MAC already exists
-    existing_mac = check_existing_mac(mac_address)
+    mac_payload = {
+        "mac_address": mac_address,
+        "assigned_object_type": "virtualization.vminterface",
+        "assigned_object_id": interface_id
+    }
 
-    if existing_mac:
-        # Update existing MAC address assignment
-        mac_payload = {
-            "mac_address": mac_address,
-            "assigned_object_type": "virtualization.vminterface",
-            "assigned_object_id": interface_id
-        }
+    def on_saved(result):
+        address_index.add_mac(result)
 
-        result = netbox_request('PATCH', f'dcim/mac-addresses/{existing_mac["id"]}/', mac_payload)
-        if result:
-            print(f"INFO: Updated MAC address assignment: {mac_address}")
-            return result
-        else:
-            print(f"ERROR: Failed to update MAC address: {mac_address}")
-            return None
-    else:
-        # Create new MAC address
-        mac_payload = {
-            "mac_address": mac_address,
-            "assigned_object_type": "virtualization.vminterface",
-            "assigned_object_id": interface_id
-        }
+    save_object(writer, 'mac', f"MAC address: {mac_address}", 'dcim/mac-addresses/', mac_payload,
+                check_existing_mac(mac_address), on_saved, key, guest=guest)
 
-        result = netbox_request('POST', 'dcim/mac-addresses/', mac_payload)
-        if result:
-            print(f"INFO: Created MAC address: {mac_address}")
-            return result
-        else:
-            print(f"ERROR: Failed to create MAC address: {mac_address}")
-            return None
+@profiling.traced('import', lambda vm_data, writer, guest=None: {'vm': vm_data.name})
+def import_vm(vm_data, writer, guest=None):
+    """Queue import of a single VM (a models.Guest) and its disks, interfaces and addresses into NetBox"""
+    vm_name = vm_data.name
+    host_name = vm_data.host
+    vm_type = vm_data.type or 'unknown'
 
-def import_vm(vm_data):
-    """Import a single VM into NetBox"""
-    vm_name = vm_data['name']
-    host_name = vm_data['host']
-    vm_type = vm_data.get('type', 'unknown')
+    key = ('vms', vm_name)
+    if writer.wait_for(key, lambda: import_vm(vm_data, writer, guest)):
+        return True
 
     print(f"INFO: Processing VM: {vm_name} from host: {host_name} (type: {vm_type})")
 
@@ -154,7 +995,7 @@ def import_vm(vm_data):
         platform_id = get_or_create_platform(vm_type)
 
     # Handle offline VMs
-    if vm_data.get('status') == 'offline':
+    if vm_data.status == 'offline':
         print(f"INFO: VM {vm_name} is offline, creating basic entry")
         vm_payload = {
             'name': vm_name,
@@ -169,49 +1010,53 @@ def import_vm(vm_data):
         vm_payload = {
             'name': vm_name,
             'status': 'active',
-            'vcpus': vm_data.get('vcpu', 1),
-            'memory': vm_data.get('ram_mb', 0),
+            'vcpus': vm_data.vcpu if vm_data.vcpu is not None else 1,
+            'memory': vm_data.ram_mb or 0,
             'cluster': int(CLUSTER_ID),
-            'comments': f"Imported from Proxmox host: {host_name}. Type: {vm_data.get('type', 'unknown')}"
+            'comments': f"Imported from Proxmox host: {host_name}. Type: {vm_type}"
         }
 
         if platform_id:
             vm_payload['platform'] = platform_id
 
-        if vm_data.get('ostype'):
-            vm_payload['comments'] += f", OS: {vm_data['ostype']}"
+        if vm_data.ostype:
+            vm_payload['comments'] += f", OS: {vm_data.ostype}"
 
     # Check if VM already exists
-    existing_vms = netbox_request('GET', f'virtualization/virtual-machines/?name={vm_name}')
-    if existing_vms and existing_vms['results']:
-        vm_id = existing_vms['results'][0]['id']
-        vm = netbox_request('PATCH', f'virtualization/virtual-machines/{vm_id}/', vm_payload)
-        print(f"INFO: Updated VM: {vm_name}")
-    else:
-        vm = netbox_request('POST', 'virtualization/virtual-machines/', vm_payload)
-        print(f"INFO: Created VM: {vm_name}")
+    # VM names are only unique per cluster, another cluster may have a guest of the same name
+    existing_vm = find_existing('vms', vm_name, 'virtualization/virtual-machines/',
+                                {'name': vm_name, 'cluster_id': CLUSTER_ID, 'exclude': VM_EXCLUDE})
 
-    if not vm:
-        print(f"ERROR: Failed to create/update VM: {vm_name}")
-        return False
+    def on_saved(vm):
+        if not existing_vm:
+            # A new VM has no disks or interfaces yet
+            netbox_state['vm_ids'].add(vm['id'])
+        netbox_state['vms'][vm_name] = vm
 
-    # Process disks for running VMs
-    if vm_data.get('status') == 'running' and 'disks' in vm_data:
-        for disk_data in vm_data['disks']:
-            create_vm_disk(vm['id'], disk_data)
+        # Process disks for running VMs
+        if vm_data.status == 'running' and vm_data.disks:
+            for disk_data in vm_data.disks:
+                create_vm_disk(vm['id'], disk_data, writer, guest)
 
-    # Process interfaces for running VMs
-    if vm_data.get('status') == 'running' and 'interfaces' in vm_data:
-        for interface_data in vm_data['interfaces']:
-            create_vm_interface(vm['id'], interface_data)
+        # Process interfaces for running VMs
+        if vm_data.status == 'running' and vm_data.interfaces:
+            for interface_data in vm_data.interfaces:
+                create_vm_interface(vm['id'], interface_data, writer, guest)
 
+    save_object(writer, 'vm', f"VM: {vm_name}", 'virtualization/virtual-machines/', vm_payload,
+                existing_vm, on_saved, key, guest=guest)
     return True
 
-def create_vm_disk(vm_id, disk_data):
-    """Create VM disk in NetBox"""
-    disk_name = disk_data['name']
-    disk_size_gb = disk_data.get('size_gb', 0)
-    disk_description = disk_data.get('description', '')
+@profiling.traced('import', lambda vm_id, disk_data, writer, guest=None: {'vm_id': vm_id, 'disk': disk_data.name})
+def create_vm_disk(vm_id, disk_data, writer, guest=None):
+    """Queue creation or update of a VM disk in NetBox"""
+    disk_name = disk_data.name
+    disk_size_gb = disk_data.size_gb or 0
+    disk_description = disk_data.description or ''
+
+    key = ('disks', (vm_id, disk_name))
+    if writer.wait_for(key, lambda: create_vm_disk(vm_id, disk_data, writer, guest)):
+        return
 
     print(f"INFO: Processing disk: {disk_name} ({disk_size_gb}GB)")
 
@@ -219,30 +1064,28 @@ def create_vm_disk(vm_id, disk_data):
     disk_payload = {
         'virtual_machine': vm_id,
         'name': disk_name,
-        'size': disk_size_gb * 1024,  # Convert GB to MB for NetBox
+        'size': int(round(disk_size_gb * 1024)),  # Convert GB to MB for NetBox
         'description': disk_description
     }
 
+    def on_saved(disk):
+        netbox_state['disks'][(vm_id, disk_name)] = disk
+
     # Check if disk already exists
-    existing_disks = netbox_request('GET', f'virtualization/virtual-disks/?virtual_machine_id={vm_id}&name={disk_name}')
-    if existing_disks and existing_disks['results']:
-        disk_id = existing_disks['results'][0]['id']
-        disk = netbox_request('PATCH', f'virtualization/virtual-disks/{disk_id}/', disk_payload)
-        if disk:
-            print(f"INFO: Updated disk: {disk_name}")
-        else:
-            print(f"ERROR: Failed to update disk: {disk_name}")
-    else:
-        disk = netbox_request('POST', 'virtualization/virtual-disks/', disk_payload)
-        if disk:
-            print(f"INFO: Created disk: {disk_name}")
-        else:
-            print(f"ERROR: Failed to create disk: {disk_name}")
+    existing_disk = find_existing('disks', (vm_id, disk_name), 'virtualization/virtual-disks/',
+                                  {'virtual_machine_id': vm_id, 'name': disk_name})
+    save_object(writer, 'disk', f"disk: {disk_name}", 'virtualization/virtual-disks/', disk_payload,
+                existing_disk, on_saved, key, guest=guest)
+
+@profiling.traced('import', lambda vm_id, interface_data, writer, guest=None: {'vm_id': vm_id, 'interface': interface_data.name})
+def create_vm_interface(vm_id, interface_data, writer, guest=None):
+    """Queue creation or update of a VM interface, followed by its MAC and IP addresses"""
+    interface_name = interface_data.name
+    mac_address = interface_data.mac or ''
 
-def create_vm_interface(vm_id, interface_data):
-    """Create VM interface and IP addresses"""
-    interface_name = interface_data['name']
-    mac_address = interface_data.get('mac', '')
+    key = ('interfaces', (vm_id, interface_name))
+    if writer.wait_for(key, lambda: create_vm_interface(vm_id, interface_data, writer, guest)):
+        return
 
     print(f"INFO: Processing interface: {interface_name}")
 
@@ -253,103 +1096,402 @@ def create_vm_interface(vm_id, interface_data):
         'type': 'virtual'
     }
 
-    # Check if interface exists
-    existing_interfaces = netbox_request('GET', f'virtualization/interfaces/?virtual_machine_id={vm_id}&name={interface_name}')
-    if existing_interfaces and existing_interfaces['results']:
-        interface_id = existing_interfaces['results'][0]['id']
-        interface = netbox_request('PATCH', f'virtualization/interfaces/{interface_id}/', interface_payload)
-        if interface:
-            print(f"INFO: Updated interface: {interface_name}")
-        else:
-            print(f"ERROR: Failed to update interface: {interface_name}")
-            return
-    else:
-        interface = netbox_request('POST', 'virtualization/interfaces/', interface_payload)
-        if interface:
-            print(f"INFO: Created interface: {interface_name}")
-            interface_id = interface['id']
-        else:
-            print(f"ERROR: Failed to create interface: {interface_name}")
-            return
+    def on_saved(interface):
+        netbox_state['interfaces'][(vm_id, interface_name)] = interface
 
-    # Handle MAC address using the MAC address API
-    if mac_address:
-        create_or_update_mac_address(mac_address, interface_id)
+        # Handle MAC address using the MAC address API
+        if mac_address:
+            create_or_update_mac_address(mac_address, interface['id'], writer, guest)
 
-    # Create IP addresses
-    for ip_data in interface_data.get('ip_addresses', []):
-        create_ip_address(interface_id, ip_data)
+        # Create IP addresses
+        for ip_data in interface_data.ip_addresses or []:
+            create_ip_address(interface['id'], ip_data, writer, guest)
 
-def create_ip_address(interface_id, ip_data):
-    """Create IP address for interface"""
-    ip_address = f"{ip_data['ip']}/{ip_data['prefix']}"
+    # Check if interface exists
+    existing_interface = find_existing('interfaces', (vm_id, interface_name), 'virtualization/interfaces/',
+                                       {'virtual_machine_id': vm_id, 'name': interface_name})
+    save_object(writer, 'interface', f"interface: {interface_name}", 'virtualization/interfaces/',
+                interface_payload, existing_interface, on_saved, key, guest=guest)
+
+@profiling.traced('import', lambda interface_id, ip_data, writer, guest=None: {'interface_id': interface_id, 'ip': ip_data.ip})
+def create_ip_address(interface_id, ip_data, writer, guest=None):
+    """Queue creation or update of an IP address for an interface"""
+    ip_address = f"{ip_data.ip}/{ip_data.prefix}"
+
+    try:
+        key = ('ips', address_index.ip_key(address_index.vrf_id, ip_address))
+    except ValueError:
+        print(f"ERROR: Invalid IP address: {ip_address}")
+        import_stats[('ip', 'failed')] += 1
+        if guest:
+            guest.failed = True
+        return
+    if writer.wait_for(key, lambda: create_ip_address(interface_id, ip_data, writer, guest)):
+        return
 
     print(f"INFO: Processing IP: {ip_address}")
 
+    # Existing IPs only get their assignment updated, status and address are set on creation
+    ip_payload = {
+        'assigned_object_type': 'virtualization.vminterface',
+        'assigned_object_id': interface_id
+    }
+
+    def on_saved(result):
+        address_index.add_ip(result)
+
     # Check if IP already exists
-    existing_ips = netbox_request('GET', f'ipam/ip-addresses/?address={ip_address}')
-    if existing_ips and existing_ips['results']:
-        # Update existing IP
-        ip_id = existing_ips['results'][0]['id']
-        ip_payload = {
-            'assigned_object_type': 'virtualization.vminterface',
-            'assigned_object_id': interface_id
-        }
-        result = netbox_request('PATCH', f'ipam/ip-addresses/{ip_id}/', ip_payload)
-        if result:
-            print(f"INFO: Updated existing IP: {ip_address}")
-        else:
-            print(f"ERROR: Failed to update IP: {ip_address}")
-    else:
-        # Create new IP
-        ip_payload = {
-            'address': ip_address,
-            'assigned_object_type': 'virtualization.vminterface',
-            'assigned_object_id': interface_id,
-            'status': 'active'
-        }
+    existing_ip = address_index.find_ip(ip_address)
+    create_fields = {'address': ip_address, 'status': 'active'}
+    if address_index.vrf_id:
+        create_fields['vrf'] = address_index.vrf_id
+    save_object(writer, 'ip', f"IP: {ip_address}", 'ipam/ip-addresses/', ip_payload, existing_ip, on_saved, key,
+                create_fields=create_fields, guest=guest)
 
-        result = netbox_request('POST', 'ipam/ip-addresses/', ip_payload)
-        if result:
-            print(f"INFO: Created IP: {ip_address}")
-        else:
-            print(f"ERROR: Failed to create IP: {ip_address}")
+class GuestFilter:
+    """Selects the guests one import run handles, by a shard of their name or host hash, hosts, types or cluster_id"""
+
+    def __init__(self, shard=None, shard_by='name', hosts=None, types=None, cluster_id=None):
+        self.shard = shard
+        self.shard_by = shard_by
+        self.hosts = set(hosts) if hosts else None
+        self.types = set(types) if types else None
+        self.cluster_id = str(cluster_id) if cluster_id else None
+
+    @property
+    def active(self):
+        return bool(self.shard or self.hosts or self.types or self.cluster_id)
+
+    @staticmethod
+    def shard_of(key, count):
+        """Return the shard number (1 to count) of a guest name or host"""
+        digest = hashlib.sha256((key or '').encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % count + 1
+
+    def matches(self, vm_data):
+        if self.cluster_id and vm_data.cluster_id is not None and str(vm_data.cluster_id) != self.cluster_id:
+            return False
+        if self.hosts is not None and vm_data.host not in self.hosts:
+            return False
+        if self.types is not None and vm_data.type not in self.types:
+            return False
+        if self.shard:
+            index, count = self.shard
+            key = vm_data.host if self.shard_by == 'host' else vm_data.name
+            return self.shard_of(key, count) == index
+        return True
+
+def parse_shard(value):
+    """Parse an "i/N" shard argument into (i, N)"""
+    index, sep, count = value.partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        index = count = 0
+    if not sep or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"expected i/N with 1 <= i <= N, got '{value}'")
+    return index, count
+
+def import_snapshot(json_file, guest_filter=None, full=False, resume=False):
+    """Import the guests guest_filter selects (skipping checkpointed ones with resume), returns (selected, skipped)"""
+    guest_filter = guest_filter or GuestFilter()
+    checkpoint = open_checkpoint(json_file, guest_filter.shard, resume, guest_filter.cluster_id)
+    resuming = checkpoint is not None and bool(checkpoint.done)
+
+    # Load existing cluster objects up front so lookups don't need one request each, with
+    # a filter or when resuming only those of the guests left to import
+    names = None
+    if guest_filter.active or resuming:
+        with metrics.phase('select'):
+            names = {vm_data.name for vm_data in read_guests(json_file) if guest_filter.matches(vm_data)
+                     and not (resuming and checkpoint.completed(vm_data.name, vm_data.hash or record_hash(vm_data)))}
+        print(f"INFO: {len(names)} VMs selected for this run")
+    with metrics.phase('prefetch'):
+        prefetched = prefetch_cluster_state(names)
+
+    # Guests are only skipped when the prefetch confirms their objects still exist
+    journal = ImportJournal(IMPORT_JOURNAL_FILE) if IMPORT_JOURNAL_FILE else None
+    current_ids = known_ids() if journal and prefetched and not full else None
+
+    total = skipped = resumed = 0
+    writer = BulkWriter()
+    guests = []
+
+    def apply_chunk():
+        writer.flush()
+        if journal:
+            with metrics.phase('journal'):
+                for guest in guests:
+                    if not guest.failed:
+                        journal.record(guest)
+                journal.commit()
+        if checkpoint:
+            for guest in guests:
+                if not guest.failed:
+                    checkpoint.guest_done(guest)
+        guests.clear()
+
+    # Snapshot records are read lazily and applied in chunks, so memory use stays flat
+    finished = False
+    try:
+        for vm_data in read_guests(json_file):
+            if not guest_filter.matches(vm_data):
+                continue
+            if vm_data.change == 'removed':
+                print(f"WARN: VM {vm_data.name} was removed from Proxmox, it is not deleted from NetBox")
+                if journal:
+                    journal.forget(vm_data.name)
+                continue
+
+            total += 1
+            guest = GuestImport(vm_data.name, vm_data.hash or record_hash(vm_data), checkpoint)
+            if resuming and checkpoint.completed(guest.name, guest.hash):
+                resumed += 1
+                continue
+            if current_ids is not None and journal_matches(journal.get(guest.name), guest, current_ids):
+                skipped += 1
+                continue
+
+            with metrics.phase('plan'):
+                import_vm(vm_data, writer, guest)
+            guests.append(guest)
+            if len(guests) >= IMPORT_CHUNK_SIZE:
+                apply_chunk()
+        apply_chunk()
+        finished = True
+    finally:
+        if journal:
+            journal.close()
+        if checkpoint:
+            checkpoint.close(finished)
+    return total, skipped + resumed
+
+def print_report(total, skipped):
+    imported = sum(import_stats[('vm', outcome)] for outcome in ('created', 'updated', 'unchanged'))
+    if skipped:
+        print(f"INFO: Skipped {skipped} VMs unchanged since the last import or finished before an interruption")
+    print(f"INFO: Successfully imported {imported + skipped}/{total} VMs")
+    print_summary()
+
+def write_summary(path, total, skipped):
+    """Save the counts of this run, so the runs of several shards can be merged"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'total': total,
+            'skipped': skipped,
+            'stats': {f'{kind}:{outcome}': count for (kind, outcome), count in import_stats.items()},
+            'metrics': metrics.report(),
+        }, f)
+
+def merge_summaries(paths):
+    """Add the counts and metrics of saved summaries to this run's, returns the summed (total, skipped)"""
+    total = skipped = 0
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            summary = json.load(f)
+        total += summary['total']
+        skipped += summary['skipped']
+        for key, count in summary['stats'].items():
+            kind, outcome = key.split(':', 1)
+            import_stats[(kind, outcome)] += count
+        if 'metrics' in summary:
+            metrics.merge(summary['metrics'])
+    return total, skipped
+
+def write_metrics(total, skipped):
+    """Write this run's metrics to IMPORT_METRICS_FILE and IMPORT_REPORT_FILE, if set"""
+    for (kind, outcome), count in import_stats.items():
+        metrics.set('objects', count, kind=kind, outcome=outcome)
+    metrics.set('guests', total - skipped, outcome='imported')
+    metrics.set('guests', skipped, outcome='skipped')
+    try:
+        metrics.write(IMPORT_METRICS_FILE, IMPORT_REPORT_FILE)
+    except OSError as e:
+        print(f"ERROR: Failed to write metrics: {e}")
+
+def snapshot_clusters(json_file):
+    """Return the NetBox cluster IDs a multi-cluster snapshot tags its guests with, sorted"""
+    records = read_snapshot(json_file)
+    first = next(records, None)
+    # Snapshots are tagged throughout or not at all, the first record tells which
+    if not first or not first.get('cluster_id'):
+        return []
+    cluster_ids = {str(first['cluster_id'])}
+    cluster_ids.update(str(record['cluster_id']) for record in records if record.get('cluster_id'))
+    return sorted(cluster_ids, key=lambda cluster_id: (len(cluster_id), cluster_id))
+
+def import_options(shard_by='name', hosts=None, types=None, full=False, resume=False):
+    """Return the command line options an import process passes on to the processes it starts"""
+    options = ['--shard-by', shard_by]
+    for host in hosts or []:
+        options += ['--host', host]
+    for vm_type in types or []:
+        options += ['--type', vm_type]
+    if full:
+        options.append('--full')
+    if resume:
+        options.append('--resume')
+    return options
+
+def relay_output(label, stream):
+    # Runs print whole lines, prefixing them keeps the interleaved output readable
+    for line in stream:
+        print(f"[{label}] {line}", end="", flush=True)
+
+def run_imports(json_file, runs, types=None, resume=False, cluster_id=None):
+    """Run an import process per (label, arguments) in parallel, returns (failed labels, total, skipped)"""
+    if IMPORT_CHECKPOINT and not resume:
+        # Every run starts its own checkpoint, none may find those of an earlier run
+        try:
+            remove_checkpoints(json_file, cluster_id)
+        except OSError as e:
+            print(f"WARN: Failed to remove the checkpoints of an earlier import: {e}")
+
+    # Create the platforms before the runs start, so they find them instead of racing
+    with metrics.phase('platforms'):
+        needed = {record.get('type') for record in read_snapshot(json_file)} & {'qemu', 'lxc'}
+        for platform_name in sorted(needed & set(types) if types else needed):
+            get_or_create_platform(platform_name)
+
+    # The runs report their metrics through their summaries, only this process writes them
+    env = dict(os.environ, PYTHONUNBUFFERED='1', IMPORT_METRICS_FILE='', IMPORT_REPORT_FILE='')
+
+    with tempfile.TemporaryDirectory() as summary_dir:
+        processes = []
+        for number, (label, arguments) in enumerate(runs, 1):
+            summary = os.path.join(summary_dir, f'run-{number}.json')
+            command = [sys.executable, os.path.abspath(__file__), json_file, *arguments, '--summary', summary]
+            if profiling.tracer.enabled:
+                command += ['--profile', os.path.join(summary_dir, f'run-{number}')]
+            process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                       text=True, encoding='utf-8', errors='replace')
+            relay = threading.Thread(target=relay_output, args=(label, process.stdout), daemon=True)
+            relay.start()
+            processes.append((number, label, summary, process, relay))
+
+        failed = []
+        for number, _, _, process, relay in processes:
+            if process.wait() != 0:
+                failed.append(number)
+            relay.join()
+        total, skipped = merge_summaries(summary for number, _, summary, _, _ in processes if number not in failed)
+        if profiling.tracer.enabled:
+            # One profile and one trace for the whole run, each process on its own track
+            for number, _, _, _, _ in processes:
+                if number not in failed:
+                    profiling.merge(os.path.join(summary_dir, f'run-{number}'))
+    return [label for number, label, _, _, _ in processes if number in failed], total, skipped
+
+def run_shards(json_file, count, shard_by='name', hosts=None, types=None, full=False, resume=False, cluster_id=None):
+    """Import a snapshot with count parallel shard processes, returns (ok, total, skipped) of all shards"""
+    options = import_options(shard_by, hosts, types, full, resume)
+    if cluster_id:
+        options += ['--cluster-id', str(cluster_id)]
+    runs = [(str(index), ['--shard', f'{index}/{count}', *options]) for index in range(1, count + 1)]
+    failed, total, skipped = run_imports(json_file, runs, types, resume, cluster_id)
+
+    print(f"INFO: Merged summary of {count} shards")
+    if failed:
+        print(f"ERROR: Shards {', '.join(failed)} of {count} failed")
+    return not failed, total, skipped
+
+def run_clusters(json_file, cluster_ids, shards=None, shard_by='name', hosts=None, types=None, full=False, resume=False):
+    """Import a multi-cluster snapshot with a parallel process per NetBox cluster, returns (ok, total, skipped)"""
+    options = import_options(shard_by, hosts, types, full, resume)
+    if shards:
+        options += ['--shards', str(shards)]
+    # Each process imports its cluster's guests, with shards of its own if asked for
+    runs = [(cluster_id, ['--cluster-id', cluster_id, *options]) for cluster_id in cluster_ids]
+    failed, total, skipped = run_imports(json_file, runs, types, resume)
+
+    print(f"INFO: Merged summary of {len(cluster_ids)} clusters")
+    if failed:
+        print(f"ERROR: Import into clusters {', '.join(failed)} failed")
+    return not failed, total, skipped
 
 def main():
     """Main import function"""
-    if len(sys.argv) != 2:
-        print("Usage: python netbox_import.py <json_file>")
-        print("Required environment variables:")
-        print("  NETBOX_URL - NetBox instance URL")
-        print("  NETBOX_TOKEN - NetBox API token")
-        print("  CLUSTER_ID - NetBox cluster ID to assign VMs to")
-        sys.exit(1)
+    global CLUSTER_ID
+    parser = argparse.ArgumentParser(
+        description='Import a proxmox_export.py snapshot into NetBox',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="Required environment variables:\n"
+               "  NETBOX_URL - NetBox instance URL\n"
+               "  NETBOX_TOKEN - NetBox API token\n"
+               "  CLUSTER_ID - NetBox cluster ID to assign VMs to, multi-cluster snapshots bring their own"
+    )
+    parser.add_argument('json_file', nargs='?',
+                        help='snapshot as JSON array or JSON Lines (.jsonl), optionally gzipped (.gz)')
+    parser.add_argument('--full', action='store_true', help='import every guest, even if the journal has it unchanged')
+    parser.add_argument('--shard', type=parse_shard, metavar='I/N', help='only import the I-th of N disjoint parts')
+    parser.add_argument('--shards', type=int, metavar='N', help='import with N parallel shard processes')
+    parser.add_argument('--shard-by', choices=['name', 'host'], default='name',
+                        help='assign guests to shards by VM name (default) or Proxmox host')
+    parser.add_argument('--host', action='append', help='only import guests of this Proxmox host (repeatable)')
+    parser.add_argument('--type', action='append', choices=['qemu', 'lxc'], help='only import guests of this type')
+    parser.add_argument('--cluster-id', metavar='ID',
+                        help='only import the guests a multi-cluster snapshot tags with this NetBox cluster, into it')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the guests an interrupted import of the same snapshot has finished')
+    parser.add_argument('--summary', metavar='FILE', help='also save the counts of this run as JSON')
+    parser.add_argument('--merge-summaries', nargs='+', metavar='FILE',
+                        help='print the merged counts of runs saved with --summary instead of importing')
+    parser.add_argument('--profile', metavar='PREFIX',
+                        help='write a cProfile dump to PREFIX.pstats and a span trace to PREFIX.trace.json')
+    args = parser.parse_args()
+    shard = f" (shard {args.shard[0]}/{args.shard[1]})" if args.shard else ""
+    profiling.start(args.profile, f'netbox_import{shard}')
+
+    if args.merge_summaries:
+        total, skipped = merge_summaries(args.merge_summaries)
+        print_report(total, skipped)
+        write_metrics(total, skipped)
+        return
+    if not args.json_file:
+        parser.error('the snapshot file is required')
+    if args.shard and args.shards:
+        parser.error('--shard and --shards are mutually exclusive')
 
-    json_file = sys.argv[1]
+    json_file = args.json_file
 
     if not os.path.exists(json_file):
         print(f"ERROR: File not found: {json_file}")
         sys.exit(1)
 
-    # Verify cluster exists
-    if not verify_cluster():
-        sys.exit(1)
-
     try:
-        with open(json_file, 'r') as f:
-            vms_data = json.load(f)
-    except json.JSONDecodeError as e:
+        # A snapshot of proxmox_export.py --clusters names the NetBox cluster of every guest
+        clusters = [args.cluster_id] if args.cluster_id else snapshot_clusters(json_file)
+        if len(clusters) > 1:
+            if args.shard:
+                parser.error('--shard of a multi-cluster snapshot needs --cluster-id')
+            print(f"INFO: Importing VMs from {json_file} into NetBox clusters {', '.join(clusters)}")
+            ok, total, skipped = run_clusters(json_file, clusters, args.shards, args.shard_by, args.host, args.type,
+                                              args.full, args.resume)
+        else:
+            if clusters:
+                CLUSTER_ID = clusters[0]
+            # Verify cluster exists
+            if not verify_cluster():
+                sys.exit(1)
+            guest_filter = GuestFilter(args.shard, args.shard_by, args.host, args.type, args.cluster_id)
+            if args.shards:
+                print(f"INFO: Importing VMs from {json_file} into NetBox cluster {CLUSTER_ID} with {args.shards} shards")
+                ok, total, skipped = run_shards(json_file, args.shards, args.shard_by, args.host, args.type,
+                                                args.full, args.resume, guest_filter.cluster_id)
+            else:
+                print(f"INFO: Importing VMs from {json_file} into NetBox cluster {CLUSTER_ID}{shard}")
+                total, skipped = import_snapshot(json_file, guest_filter, args.full, args.resume)
+                ok = True
+    except SnapshotError as e:
         print(f"ERROR: Invalid JSON file: {e}")
         sys.exit(1)
 
-    print(f"INFO: Importing {len(vms_data)} VMs into NetBox cluster {CLUSTER_ID}")
-
-    success_count = 0
-    for vm_data in vms_data:
-        if import_vm(vm_data):
-            success_count += 1
-
-    print(f"INFO: Successfully imported {success_count}/{len(vms_data)} VMs")
+    if args.summary:
+        write_summary(args.summary, total, skipped)
+    print_report(total, skipped)
+    write_metrics(total, skipped)
+    if not ok:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,220 @@
+"""Profiling of proxmox_export.py, netbox_import.py and proxmox_sync.py runs
+
+With --profile PREFIX a script writes two files when it exits:
+
+- PREFIX.pstats, a cProfile dump of every thread of the run (pstats, snakeviz),
+- PREFIX.trace.json, a span trace in the Chrome trace event format (Perfetto,
+  chrome://tracing) with the nodes, guests, API calls, phases and import stages of the
+  run, each on the thread it ran on.
+
+Spans are only recorded while profiling, otherwise tracer.span() and @traced cost a flag check.
+"""
+
+import atexit
+import cProfile
+import functools
+import itertools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer:
+    """Thread-safe collector of spans in the Chrome trace event format"""
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.process_name = None
+        self.events = []
+        self.threads = {}  # native thread ID -> thread name
+        self.async_ids = itertools.count(1)
+        self.origin = 0.0
+
+    def start(self, process_name):
+        with self.lock:
+            self.process_name = process_name
+            self.events = []
+            self.threads = {}
+        # Trace timestamps are wall clock microseconds, so the traces of several processes line up
+        self.origin = time.time() - time.monotonic()
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def timestamp(self, monotonic):
+        return round((self.origin + monotonic) * 1e6, 3)
+
+    def add(self, name, category, start, end, args=None):
+        """Add a span of the current thread between two time.monotonic() values"""
+        if not self.enabled:
+            return
+        thread = threading.current_thread()
+        tid = thread.native_id
+        event = {"name": name, "cat": category, "ph": "X", "ts": self.timestamp(start),
+                 "dur": round((end - start) * 1e6, 3), "pid": os.getpid(), "tid": tid}
+        if args:
+            event["args"] = args
+        with self.lock:
+            self.events.append(event)
+            self.threads.setdefault(tid, thread.name)
+
+    def add_async(self, name, category, start, end, args=None):
+        """Add a span that isn't bound to one thread, e.g. a node whose guests run on a pool"""
+        if not self.enabled:
+            return
+        span_id = next(self.async_ids)
+        begin = {"name": name, "cat": category, "ph": "b", "id": span_id, "ts": self.timestamp(start),
+                 "pid": os.getpid(), "tid": 0}
+        if args:
+            begin["args"] = args
+        with self.lock:
+            self.events.append(begin)
+            self.events.append(dict(begin, ph="e", ts=self.timestamp(end), args={}))
+
+    @contextmanager
+    def span(self, name, category, /, **args):
+        """Record the enclosed block as a span, an exception is added to its args"""
+        if not self.enabled:
+            yield
+            return
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            args["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.add(name, category, start, time.monotonic(), args)
+
+    def merge(self, path):
+        """Add the events of another process's trace, e.g. of an import shard"""
+        with open(path, encoding="utf-8") as f:
+            events = json.load(f)["traceEvents"]
+        with self.lock:
+            self.events.extend(events)
+
+    def write(self, path):
+        with self.lock:
+            pid = os.getpid()
+            metadata = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": self.process_name}}]
+            metadata += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                         for tid, name in self.threads.items()]
+            # Span args may hold non-JSON values such as the guest model's ipaddress objects
+            text = json.dumps({"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}, default=str)
+        temp = f"{path}.{pid}.tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(temp, path)
+
+
+class Profiler:
+    """cProfile of the calling thread and every thread started while it runs"""
+
+    # Before Python 3.12 cProfile only sees the thread that enabled it, so every new thread gets
+    # its own profile through threading.setprofile() and they are merged when written. Since 3.12
+    # it uses sys.monitoring, which sees every thread but allows one profiler per process.
+    PER_THREAD = sys.version_info < (3, 12)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = []
+        self.merged = []
+
+    def start(self):
+        self.profiles = [cProfile.Profile()]
+        self.merged = []
+        if self.PER_THREAD:
+            threading.setprofile(self._start_thread)
+        self.profiles[0].enable()
+
+    def _start_thread(self, frame, event, arg):
+        # Called on the first profiler event of a new thread, enabling replaces this hook
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def stop(self):
+        if self.PER_THREAD:
+            threading.setprofile(None)
+        self.profiles[0].disable()
+
+    def merge(self, path):
+        """Add the stats of another process's dump, e.g. of an import shard"""
+        self.merged.append(pstats.Stats(path))
+
+    def write(self, path):
+        stats = pstats.Stats(self.profiles[0])
+        with self.lock:
+            profiles = self.profiles[1:]
+        for profile in profiles:
+            # Threads that never ran Python code since their profile was enabled have no stats
+            profile.create_stats()
+            if profile.stats:
+                stats.add(profile)
+        for other in self.merged:
+            stats.add(other)
+        stats.dump_stats(path)
+
+
+tracer = Tracer()
+profiler = Profiler()
+_prefix = None
+
+
+def start(prefix, process_name=None):
+    """Profile and trace the rest of the run, writing PREFIX.pstats and PREFIX.trace.json at exit"""
+    global _prefix
+    if not prefix or _prefix:
+        return
+    _prefix = prefix
+    tracer.start(process_name or os.path.basename(sys.argv[0]))
+    profiler.start()
+    atexit.register(stop)
+
+
+def stop():
+    """Stop profiling and write the files, called at exit"""
+    global _prefix
+    if not _prefix:
+        return
+    prefix, _prefix = _prefix, None
+    profiler.stop()
+    tracer.stop()
+    try:
+        profiler.write(f"{prefix}.pstats")
+        tracer.write(f"{prefix}.trace.json")
+        print(f"INFO: Profile written to {prefix}.pstats, trace to {prefix}.trace.json")
+    except OSError as e:
+        print(f"ERROR: Failed to write profile: {e}")
+
+
+def merge(prefix):
+    """Add the profile and trace another process wrote with --profile PREFIX to this run's"""
+    try:
+        profiler.merge(f"{prefix}.pstats")
+        tracer.merge(f"{prefix}.trace.json")
+    except (OSError, ValueError, KeyError) as e:
+        print(f"WARN: Failed to merge profile {prefix}: {e}")
+
+
+def traced(category, describe=None):
+    """Decorator recording each call as a span named after the function
+
+    describe receives the call's arguments and returns the span's args, e.g. the VM name.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(func.__name__, category, **(describe(*args, **kwargs) if describe else {})):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+"""Record Proxmox API responses to a cassette, replay them offline and scale them up
+
+A cassette holds, per API call (path and parameters), every response Proxmox gave during a
+recording, with its latency, or the error raised, or that no answer came before the
+recording ended (e.g. a hanging guest agent). proxmox_export.py records one when
+PROXMOX_RECORD is set and, with PROXMOX_REPLAY, crawls a ReplayProxmox stand-in instead of a
+live cluster: every call is answered from the cassette after its recorded latency, repeated
+calls get the recorded responses in order. Files ending in .gz are gzip compressed.
+
+The scaler clones the guests of a cassette into a larger synthetic cluster, with unique
+VMIDs, names, MAC and IP addresses and config digests, spread over the original or a given
+number of nodes:
+
+    python proxmox_cassette.py scale cluster.json.gz cluster-50k.json.gz --guests 50000 --nodes 100
+"""
+
+import argparse
+import hashlib
+import ipaddress
+import json
+import re
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+from snapshot import open_snapshot
+
+CASSETTE_VERSION = 1
+GUEST_KEY_RE = re.compile(r"^nodes/([^/]+)/(qemu|lxc)/(\d+)/(.+)$")
+NODE_LIST_KEY_RE = re.compile(r"^nodes/([^/]+)/(qemu|lxc)$")
+MAC_RE = re.compile(r"^[0-9A-Fa-f]{2}(?::[0-9A-Fa-f]{2}){5}$")
+NET_KEY_RE = re.compile(r"^net\d+$")
+
+
+class ReplayError(Exception):
+    """Raised by ReplayProxmox for recorded errors and calls that aren't in the cassette"""
+
+
+def call_key(path, params):
+    """Return the cassette key of a call: the API path plus its sorted parameters"""
+    return f"{path}?{urlencode(sorted(params.items()))}" if params else path
+
+
+class Cassette:
+    """Recorded calls as {key: [[latency, outcome, value]]}, outcome is "ok", "error" or "hang"
+
+    For "ok" the value is the response, for "error" the error message; "hang" calls never
+    answered, their latency is how long the recording waited.
+    """
+
+    def __init__(self, calls=None):
+        self.calls = calls or {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        with open_snapshot(path) as f:
+            data = json.load(f)
+        if data.get("version") != CASSETTE_VERSION:
+            raise ValueError(f"unsupported cassette version {data.get('version')} in {path}")
+        return cls(data["calls"])
+
+    def save(self, path):
+        with self.lock, open_snapshot(path, "w") as f:
+            json.dump({"version": CASSETTE_VERSION, "calls": self.calls}, f, separators=(",", ":"))
+
+    def add(self, key, latency, outcome, value=None):
+        with self.lock:
+            self.calls.setdefault(key, []).append([round(latency, 4), outcome, value])
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.calls.values())
+
+
+class _Resource:
+    """proxmoxer-style resource path: attributes and calls append path segments"""
+
+    def __init__(self, client, path):
+        self._client = client
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return _Resource(self._client, self._path + (name,))
+
+    def __call__(self, *segments):
+        return _Resource(self._client, self._path + tuple(str(segment) for segment in segments))
+
+    def get(self, *segments, **params):
+        return self._client._get(self._path + tuple(str(segment) for segment in segments), params)
+
+
+class RecordingProxmox(_Resource):
+    """Wraps a ProxmoxAPI client and records every GET it answers into a Cassette"""
+
+    def __init__(self, api):
+        super().__init__(self, ())
+        self._api = api
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.cassette = Cassette()
+
+    def _get(self, path, params):
+        key = call_key("/".join(path), params)
+        token = object()
+        start = time.monotonic()
+        with self._lock:
+            self._pending[token] = (key, start)
+        try:
+            resource = self._api
+            for segment in path:
+                resource = getattr(resource, segment) if segment.isidentifier() else resource(segment)
+            result = resource.get(**params)
+        except Exception as e:
+            self._finish(token, key, start, "error", str(e))
+            raise
+        self._finish(token, key, start, "ok", result)
+        return result
+
+    def _finish(self, token, key, start, outcome, value):
+        with self._lock:
+            if self._pending.pop(token, None) is None:
+                return  # already saved as hanging
+        self.cassette.add(key, time.monotonic() - start, outcome, value)
+
+    def save(self, path):
+        """Write the cassette, calls still waiting for an answer are recorded as hanging"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        now = time.monotonic()
+        for key, start in pending.values():
+            self.cassette.add(key, now - start, "hang")
+        self.cassette.save(path)
+        print(f"INFO: Recorded {len(self.cassette)} Proxmox API responses to {path}")
+
+
+class ReplayProxmox(_Resource):
+    """Stand-in for a ProxmoxAPI client that answers from a Cassette
+
+    Each call waits its recorded latency times latency_scale. Responses are decoded from
+    JSON on every call, like proxmoxer does, so callers get fresh objects.
+    """
+
+    def __init__(self, cassette, latency_scale=1.0):
+        super().__init__(self, ())
+        self._latency_scale = latency_scale
+        self._lock = threading.Lock()
+        self._served = {}
+        self._calls = {
+            key: [(latency, outcome, json.dumps(value) if outcome == "ok" else value)
+                  for latency, outcome, value in entries]
+            for key, entries in cassette.calls.items()
+        }
+
+    def _get(self, path, params):
+        key = call_key("/".join(path), params)
+        entries = self._calls.get(key)
+        if not entries:
+            raise ReplayError(f"{key} is not in the cassette")
+        with self._lock:
+            index = self._served.get(key, 0)
+            self._served[key] = index + 1
+        latency, outcome, value = entries[min(index, len(entries) - 1)]
+
+        if latency and self._latency_scale:
+            time.sleep(latency * self._latency_scale)
+        if outcome == "ok":
+            return json.loads(value)
+        if outcome == "hang":
+            raise ReplayError(f"no answer within {latency:g}s while recording")
+        raise ReplayError(value)
+
+
+class GuestRewriter:
+    """Rewrites the config and agent data of a cloned guest to its own identity
+
+    MAC addresses and IPs are mapped consistently within the guest, so the config and the
+    agent still agree; loopback and link-local addresses are kept. IPv4 addresses keep their
+    first octet (so filters on e.g. 172.* still apply), IPv6 addresses their /64.
+    """
+
+    def __init__(self, source_vmid, vmid, name, index):
+        self.vmid = vmid
+        self.name = name
+        self.index = index
+        self.volume_re = re.compile(rf"\b(vm|base|subvol)-{source_vmid}-")
+        self.macs = {}
+        self.ips = {}
+
+    def mac(self, value):
+        key = value.lower()
+        if key not in self.macs:
+            octets = [self.index >> shift & 255 for shift in (24, 16, 8, 0)] + [len(self.macs) & 255]
+            self.macs[key] = "02:" + ":".join(f"{octet:02x}" for octet in octets)
+        return self.macs[key].upper() if value.isupper() else self.macs[key]
+
+    def ip(self, value):
+        try:
+            address = ipaddress.ip_address(value)
+        except ValueError:
+            return value
+        if address.is_loopback or address.is_link_local:
+            return value
+        if value not in self.ips:
+            host = self.index * 16 + len(self.ips) % 16
+            if address.version == 4:
+                self.ips[value] = str(ipaddress.IPv4Address(int(address) & 0xFF000000 | host % (1 << 24)))
+            else:
+                self.ips[value] = str(ipaddress.IPv6Address(int(address) >> 64 << 64 | host))
+        return self.ips[value]
+
+    def property_string(self, value):
+        parts = []
+        for part in value.split(","):
+            key, sep, val = part.partition("=")
+            if sep and MAC_RE.match(val):
+                part = f"{key}={self.mac(val)}"
+            elif sep and key in ("ip", "ip6") and "/" in val:
+                address, _, prefix = val.partition("/")
+                part = f"{key}={self.ip(address)}/{prefix}"
+            parts.append(part)
+        return ",".join(parts)
+
+    def config(self, config):
+        rewritten = {}
+        for key, value in config.items():
+            if key == "digest":
+                value = hashlib.sha1(f"{value}:{self.vmid}".encode("utf-8")).hexdigest()
+            elif key in ("name", "hostname"):
+                value = self.name
+            elif isinstance(value, str):
+                value = self.volume_re.sub(rf"\g<1>-{self.vmid}-", value)
+                if NET_KEY_RE.match(key):
+                    value = self.property_string(value)
+            rewritten[key] = value
+        return rewritten
+
+    def agent(self, data):
+        result = []
+        for iface in data.get("result", []):
+            iface = dict(iface)
+            if "hardware-address" in iface:
+                iface["hardware-address"] = self.mac(iface["hardware-address"])
+            iface["ip-addresses"] = [dict(ip, **{"ip-address": self.ip(ip["ip-address"])})
+                                     for ip in iface.get("ip-addresses", [])]
+            result.append(iface)
+        return dict(data, result=result)
+
+    def rewrite(self, suffix, value):
+        if suffix == "config":
+            return self.config(value)
+        if suffix.startswith("agent/") and isinstance(value, dict):
+            return self.agent(value)
+        return value
+
+
+def source_guests(cassette):
+    """Return [(node, type, vmid, inventory entry)] of the recorded guests"""
+    guests = {}
+    for key, entries in cassette.calls.items():
+        match = NODE_LIST_KEY_RE.match(key)
+        if match and entries[0][1] == "ok":
+            for vm in entries[0][2]:
+                guests[(match.group(1), match.group(2), int(vm["vmid"]))] = vm
+    for res in first_response(cassette, "cluster/resources?type=vm") or []:
+        if res.get("type") in ("qemu", "lxc"):
+            guests[(res["node"], res["type"], int(res["vmid"]))] = res
+    return [(node, vtype, vmid, vm) for (node, vtype, vmid), vm in sorted(guests.items())]
+
+
+def first_response(cassette, key):
+    entries = cassette.calls.get(key)
+    return entries[0][2] if entries and entries[0][1] == "ok" else None
+
+
+def scale(cassette, guests, nodes=None):
+    """Return a cassette of a synthetic cluster with the given number of guests cloned from cassette"""
+    source = source_guests(cassette)
+    if not source:
+        raise ValueError("the cassette contains no guests")
+    node_entries = {node["node"]: node for node in first_response(cassette, "nodes") or []}
+    node_names = sorted(node_entries) or sorted({node for node, _, _, _ in source})
+    node_count = nodes or len(node_names)
+    new_nodes = [node_names[n % len(node_names)] + (f"-{n // len(node_names)}" if n >= len(node_names) else "")
+                 for n in range(node_count)]
+
+    guest_calls = {}
+    for key, entries in cassette.calls.items():
+        match = GUEST_KEY_RE.match(key)
+        if match:
+            node, vtype, vmid, suffix = match.groups()
+            guest_calls.setdefault((node, vtype, int(vmid)), []).append((suffix, entries))
+
+    scaled = Cassette({key: entries for key, entries in cassette.calls.items()
+                       if not key.startswith(("nodes", "cluster/resources"))})
+    resources, node_lists = [], {}
+    for index in range(guests):
+        copy, i = divmod(index, len(source))
+        node, vtype, source_vmid, vm = source[i]
+        node_index = node_names.index(node) if node in node_names else i
+        new_node = new_nodes[(node_index + copy * len(node_names)) % node_count]
+        vmid = 100 + index
+        name = vm.get("name", f"guest-{source_vmid}") + (f"-{copy}" if copy else "")
+        rewriter = GuestRewriter(source_vmid, vmid, name, index)
+
+        entry = dict(vm, vmid=vmid, name=name)
+        resources.append(dict(entry, node=new_node, type=vtype, id=f"{vtype}/{vmid}"))
+        node_lists.setdefault((new_node, vtype), []).append(entry)
+        for suffix, entries in guest_calls.get((node, vtype, source_vmid), []):
+            scaled.calls[f"nodes/{new_node}/{vtype}/{vmid}/{suffix}"] = [
+                [latency, outcome, rewriter.rewrite(suffix, value) if outcome == "ok" else value]
+                for latency, outcome, value in entries
+            ]
+
+    def latency_of(key, default=0.0):
+        entries = cassette.calls.get(key)
+        return entries[0][0] if entries else default
+
+    template = next(iter(node_entries.values()), {})
+    scaled.calls["nodes"] = [[latency_of("nodes"), "ok", [
+        dict(node_entries.get(node_names[n % len(node_names)], template), node=new_node, id=f"node/{new_node}")
+        for n, new_node in enumerate(new_nodes)
+    ]]]
+    scaled.calls["cluster/resources?type=vm"] = [[latency_of("cluster/resources?type=vm"), "ok", resources]]
+    list_latency = {vtype: latency_of(f"nodes/{node_names[0]}/{vtype}") for vtype in ("qemu", "lxc")}
+    for new_node in new_nodes:
+        for vtype in ("qemu", "lxc"):
+            scaled.calls[f"nodes/{new_node}/{vtype}"] = [[list_latency[vtype], "ok", node_lists.get((new_node, vtype), [])]]
+    return scaled
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tools for Proxmox API cassettes")
+    commands = parser.add_subparsers(dest="command", required=True)
+    scale_parser = commands.add_parser("scale", help="clone the guests of a cassette into a larger synthetic cluster")
+    scale_parser.add_argument("source", help="recorded cassette")
+    scale_parser.add_argument("target", help="cassette to write (.json, optionally .gz)")
+    scale_parser.add_argument("--guests", type=int, required=True, help="number of guests of the synthetic cluster")
+    scale_parser.add_argument("--nodes", type=int, help="number of nodes, default: as many as recorded")
+    args = parser.parse_args()
+
+    try:
+        cassette = Cassette.load(args.source)
+        scaled = scale(cassette, args.guests, args.nodes)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    scaled.save(args.target)
+    print(f"INFO: Wrote {args.guests} guests on {len(first_response(scaled, 'nodes'))} nodes to {args.target}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,24 @@
 #!/usr/bin/env python3
 
+import argparse
+import configparser
 import json
 import re
 import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from proxmoxer import ProxmoxAPI
+from metrics import Metrics
+from models import Disk, Guest, Interface
+import profiling
+from proxmox_cassette import Cassette, RecordingProxmox, ReplayProxmox
+from snapshot import SnapshotWriter, read_snapshot, record_hash
 
 load_dotenv()
 
@@ -13,66 +27,87 @@ PROXMOX_USER = os.getenv("PROXMOX_USER")  # format: username@realm
 API_TOKEN_NAME = os.getenv("API_TOKEN_NAME")
 API_TOKEN_VALUE = os.getenv("API_TOKEN_VALUE")
 VERIFY_SSL = False if os.getenv("VERIFY_SSL", "false").lower() == "false" else True
-
-print(f"INFO: Connecting to: {PROXMOX_HOST}")
-print(f"INFO: User: {PROXMOX_USER}")
-
-try:
-    # Initialize Proxmox API with token authentication
-    proxmox = ProxmoxAPI(
-        PROXMOX_HOST,
-        user=PROXMOX_USER,
-        token_name=API_TOKEN_NAME,
-        token_value=API_TOKEN_VALUE,
-        verify_ssl=VERIFY_SSL
-    )
-
-    # Test connection
-    version = proxmox.version.get()
-    print(f"INFO: Connected to Proxmox VE {version['version']}")
-
-    # Get all nodes
-    nodes = proxmox.nodes.get()
-    print(f"INFO: Found {len(nodes)} nodes: {[node['node'] for node in nodes]}")
-
-except Exception as e:
-    print(f"ERROR: Connection failed: {e}")
-    exit(1)
-
-all_vms = []
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "8"))  # concurrent guest requests across the cluster
+EXPORT_NODE_WORKERS = int(os.getenv("EXPORT_NODE_WORKERS", "4"))  # concurrent guest requests per node
+EXPORT_INVENTORY = os.getenv("EXPORT_INVENTORY", "resources")  # "resources" (one cluster-wide call) or "nodes"
+EXPORT_CACHE_FILE = os.getenv("EXPORT_CACHE_FILE")  # SQLite cache for incremental exports, disabled when unset
+AGENT_CACHE_TTL = int(os.getenv("AGENT_CACHE_TTL", "3600"))  # seconds a cached guest agent result stays valid
+AGENT_TIMEOUT = float(os.getenv("AGENT_TIMEOUT", "5"))  # seconds to wait for a guest agent answer
+AGENT_RETRY_AFTER = int(os.getenv("AGENT_RETRY_AFTER", "21600"))  # seconds before a failed guest agent is probed again
+EXPORT_METRICS_FILE = os.getenv("EXPORT_METRICS_FILE")  # OpenMetrics textfile written after each run
+EXPORT_REPORT_FILE = os.getenv("EXPORT_REPORT_FILE")  # JSON run report written after each run
+PROXMOX_RECORD = os.getenv("PROXMOX_RECORD")  # cassette file to record all Proxmox API responses to
+PROXMOX_REPLAY = os.getenv("PROXMOX_REPLAY")  # cassette file to answer from instead of a live cluster
+PROXMOX_REPLAY_LATENCY = float(os.getenv("PROXMOX_REPLAY_LATENCY", "1"))  # factor for the recorded latencies
+EXPORT_CLUSTER_TIMEOUT = float(os.getenv("EXPORT_CLUSTER_TIMEOUT", "1800"))  # per cluster of --clusters, 0 = no limit
+
+# Config keys holding disks, container mount points and network devices
+DISK_KEY_RE = re.compile(r"^(?:scsi|virtio|sata|ide)\d+$")
+MOUNTPOINT_KEY_RE = re.compile(r"^mp\d+$")
+NET_KEY_RE = re.compile(r"^net\d+$")
+MAC_RE = re.compile(r"^[0-9A-Fa-f]{2}(?::[0-9A-Fa-f]{2}){5}$")
+SIZE_RE = re.compile(r"^(\d+(?:\.\d+)?)([KMGT]?)$")
+SIZE_UNITS_GB = {"": 1 / 1024 ** 3, "K": 1 / 1024 ** 2, "M": 1 / 1024, "G": 1, "T": 1024}
+
+metrics = Metrics("proxmox_export")
+# Guest agents that failed in this process, (node, vmid) -> (digest, retry at), ahead of the export cache
+agent_failures = {}
+# Agent calls in flight, abandoned ones included until Proxmox gives up on them
+agent_slots = threading.BoundedSemaphore(max(1, EXPORT_WORKERS))
+
+def parse_property_string(value):
+    """Split a Proxmox property string ("volume,key=value,...") into a dict
+
+    Entries without "=", like the volume of a disk, are stored under the None key.
+    """
+    props = {}
+    for part in str(value).split(","):
+        key, sep, val = part.partition("=")
+        if sep:
+            props[key] = val
+        elif part and None not in props:
+            props[None] = part
+    return props
+
+def parse_size_gb(size):
+    """Convert a Proxmox size ("32G", "512M", "1T", bytes without unit) to GB"""
+    match = SIZE_RE.match(size or "")
+    if not match:
+        return 0
+    number, unit = match.groups()
+    size_gb = round(float(number) * SIZE_UNITS_GB[unit], 3)
+    return int(size_gb) if size_gb.is_integer() else size_gb
 
 def parse_disk_size(disk_str):
     if not disk_str:
         return 0
-    match = re.search(r"size=(\d+)([GM])", str(disk_str))
-    if not match:
-        return 0
-    size, unit = match.groups()
-    return int(size) if unit == "G" else int(size) * 1024
+    return parse_size_gb(parse_property_string(disk_str).get("size"))
+
+def parse_cidr(value, skip_prefixes):
+    """Split "address/prefix" into an IP entry, None for dhcp/auto/manual or skipped ranges"""
+    ip, sep, prefix = (value or "").partition("/")
+    if not sep or not prefix.isdigit() or ip.lower().startswith(skip_prefixes):
+        return None
+    return {"ip": ip, "prefix": int(prefix)}
 
 def extract_disk_info(config):
     """Extract individual disk information from QEMU VM config"""
     disks = []
-    disk_patterns = [r"^(scsi\d+)$", r"^(virtio\d+)$", r"^(sata\d+)$", r"^(ide\d+)$"]
 
     for key, val in config.items():
-        # Check if this key matches any disk pattern
-        for pattern in disk_patterns:
-            if re.match(pattern, key):
-                # Skip CD-ROM/cloudinit disks
-                if "media=cdrom" in str(val) or "cloudinit" in str(val):
-                    continue
+        if not DISK_KEY_RE.match(key):
+            continue
 
-                # Parse disk size
-                disk_size_gb = parse_disk_size(str(val))
+        props = parse_property_string(val)
+        # Skip CD-ROM/cloudinit disks
+        if props.get("media") == "cdrom" or "cloudinit" in (props.get(None) or ""):
+            continue
 
-                disk_info = {
-                    "name": key,
-                    "size_gb": disk_size_gb,
-                    "description": str(val)
-                }
-                disks.append(disk_info)
-                break
+        disks.append({
+            "name": key,
+            "size_gb": parse_size_gb(props.get("size")),
+            "description": str(val)
+        })
 
     return disks
 
@@ -80,78 +115,71 @@ def extract_lxc_disk_info(config):
     """Extract disk information from LXC container config"""
     disks = []
     if "rootfs" in config:
-        disk_size_gb = parse_disk_size(config["rootfs"])
-        disk_info = {
+        disks.append({
             "name": "rootfs",
-            "size_gb": disk_size_gb,
+            "size_gb": parse_disk_size(config["rootfs"]),
             "description": str(config["rootfs"])
-        }
-        disks.append(disk_info)
+        })
 
     # Check for additional mount points (mp0, mp1, etc.)
     for key, val in config.items():
-        if re.match(r"^mp\d+$", key):
-            disk_size_gb = parse_disk_size(str(val))
-            disk_info = {
+        if MOUNTPOINT_KEY_RE.match(key):
+            disks.append({
                 "name": key,
-                "size_gb": disk_size_gb,
+                "size_gb": parse_disk_size(val),
                 "description": str(val)
-            }
-            disks.append(disk_info)
+            })
 
     return disks
 
 def extract_lxc_net(config):
     interfaces = []
     for key, val in config.items():
-        if key.startswith("net"):
-            entry = {}
-            m_name = re.search(r"name=(\w+)", val)
-            m_mac = re.search(r"hwaddr=([0-9A-Fa-f:]+)", val)
-            m_ip4 = re.findall(r"ip=([\d\.]+/\d+)", val)
-            m_ip6 = re.findall(r"ip6=([0-9a-fA-F:]+/\d+)", val)
-
-            if m_name:
-                entry["name"] = m_name.group(1)
-            if m_mac:
-                entry["mac"] = m_mac.group(1).lower()
-
-            entry["ip_addresses"] = []
-
-            # IPv4 addresses
-            for ip_cidr in m_ip4:
-                ip, prefix = ip_cidr.split('/')
-                if ip.startswith("127.") or ip.startswith("172."):
-                    continue
-                entry["ip_addresses"].append({"ip": ip, "prefix": int(prefix)})
+        if not NET_KEY_RE.match(key):
+            continue
+
+        props = parse_property_string(val)
+        entry = {}
+        if "name" in props:
+            entry["name"] = props["name"]
+        if MAC_RE.match(props.get("hwaddr", "")):
+            entry["mac"] = props["hwaddr"].lower()
+
+        entry["ip_addresses"] = []
 
-            # IPv6 addresses
-            for ip_cidr in m_ip6:
-                ip, prefix = ip_cidr.split('/')
-                if ip.lower().startswith("fe80::"):
-                    continue  # Skip link-local addresses
-                entry["ip_addresses"].append({"ip": ip, "prefix": int(prefix)})
+        # IPv4 addresses, skipping loopback and private docker networks
+        ip4 = parse_cidr(props.get("ip"), ("127.", "172."))
+        if ip4:
+            entry["ip_addresses"].append(ip4)
 
-            interfaces.append(entry)
+        # IPv6 addresses, skipping link-local addresses
+        ip6 = parse_cidr(props.get("ip6"), ("fe80::",))
+        if ip6:
+            entry["ip_addresses"].append(ip6)
+
+        interfaces.append(entry)
     return interfaces
 
 def get_qemu_net_interfaces(config):
     interfaces = []
     for key, val in config.items():
-        if re.match(r"^net\d+$", key):
-            entry = {}
-            m_mac = re.search(r"([0-9A-Fa-f:]{17})", val)
-            m_bridge = re.search(r"bridge=(\w+)", val)
-
-            if m_mac:
-                entry["mac"] = m_mac.group(1).lower()
-            if m_bridge:
-                entry["name"] = m_bridge.group(1)
-            else:
-                entry["name"] = f"net{len(interfaces)}"
-
-            entry["ip_addresses"] = []
-            interfaces.append(entry)
+        if not NET_KEY_RE.match(key):
+            continue
+
+        props = parse_property_string(val)
+        entry = {}
+        # The MAC is the value of the model key ("virtio=BC:24:11:...") or of macaddr
+        mac = next((v for v in props.values() if MAC_RE.match(v)), None)
+
+        if mac:
+            entry["mac"] = mac.lower()
+        if props.get("bridge"):
+            entry["name"] = props["bridge"]
+        else:
+            entry["name"] = f"net{len(interfaces)}"
+
+        entry["ip_addresses"] = []
+        interfaces.append(entry)
     return interfaces
 
 def is_ipv6(ip):
@@ -162,131 +190,618 @@ def should_skip_interface(ifname):
     skip_prefixes = ["br-", "lo", "Loopback", "veth", "docker", "tun", "tailscale"]
     return any(ifname.startswith(prefix) for prefix in skip_prefixes)
 
-# Process all nodes
-for node in nodes:
-    node_name = node['node']
-    print(f"\nINFO: Processing node: {node_name}")
+class ExportCache:
+    """SQLite cache of parsed guest configs and guest agent results, keyed by node and VMID"""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS guests ("
+            "node TEXT, vmid INTEGER, digest TEXT, parsed TEXT, agent_interfaces TEXT, agent_at REAL, "
+            "PRIMARY KEY (node, vmid))"
+        )
+        # Guests whose agent didn't answer, and when it should be probed again
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS agent_failures (node TEXT, vmid INTEGER, digest TEXT, retry_at REAL, "
+            "PRIMARY KEY (node, vmid))"
+        )
+
+    def get(self, node, vmid):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT digest, parsed, agent_interfaces, agent_at FROM guests WHERE node = ? AND vmid = ?",
+                (node, vmid)
+            ).fetchone()
+        if not row:
+            return None
+        digest, parsed, agent_interfaces, agent_at = row
+        return {
+            "digest": digest,
+            "parsed": json.loads(parsed),
+            "agent_interfaces": json.loads(agent_interfaces) if agent_interfaces else None,
+            "agent_at": agent_at
+        }
 
+    def put(self, node, vmid, digest, parsed, agent_interfaces, agent_at):
+        with self.lock:
+            self.seen.add((node, vmid))
+            self.db.execute(
+                "INSERT OR REPLACE INTO guests VALUES (?, ?, ?, ?, ?, ?)",
+                (node, vmid, digest, json.dumps(parsed),
+                 json.dumps(agent_interfaces) if agent_interfaces is not None else None, agent_at)
+            )
+
+    def agent_skipped(self, node, vmid, digest):
+        """Return True if the agent of the guest failed recently and its config didn't change since"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT digest, retry_at FROM agent_failures WHERE node = ? AND vmid = ?", (node, vmid)
+            ).fetchone()
+        return bool(row) and row[0] == digest and time.time() < row[1]
+
+    def agent_failed(self, node, vmid, digest):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO agent_failures VALUES (?, ?, ?, ?)",
+                (node, vmid, digest, time.time() + AGENT_RETRY_AFTER)
+            )
+
+    def agent_answered(self, node, vmid):
+        with self.lock:
+            self.db.execute("DELETE FROM agent_failures WHERE node = ? AND vmid = ?", (node, vmid))
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self, prune=False):
+        """Commit the cache, dropping guests not stored during this run if prune is set"""
+        with self.lock:
+            if prune:
+                rows = self.db.execute("SELECT node, vmid FROM guests").fetchall()
+                stale = [row for row in rows if row not in self.seen]
+                self.db.executemany("DELETE FROM guests WHERE node = ? AND vmid = ?", stale)
+                self.db.execute("DELETE FROM agent_failures WHERE retry_at < ?", (time.time(),))
+            self.db.commit()
+            self.db.close()
+
+def connect():
+    """Connect to Proxmox, or its PROXMOX_REPLAY or PROXMOX_RECORD stand-in, and return the API client and nodes"""
     try:
-        vm_list = proxmox.nodes(node_name).qemu.get()
-        lxc_list = proxmox.nodes(node_name).lxc.get()
-
-        print(f"INFO: Found {len(vm_list)} QEMU VMs")
-        print(f"INFO: Found {len(lxc_list)} LXC containers")
-
-        for vm in vm_list + lxc_list:
-            vmid = vm["vmid"]
-            vtype = "qemu" if vm in vm_list else "lxc"
-            vm_status = vm.get("status", "unknown")
-
-            print(f"INFO: Processing {vtype} VM {vmid}: {vm['name']} (status: {vm_status})")
-
-            # Check if VM/LXC is running
-            if vm_status != "running":
-                print(f"WARN: VM {vmid} is not running, marking as offline")
-                vm_data = {
-                    "name": vm["name"],
-                    "type": vtype,
-                    "status": "offline",
-                    "host": node_name
-                }
-                all_vms.append(vm_data)
-                continue
+        if PROXMOX_REPLAY:
+            print(f"INFO: Replaying Proxmox API responses from {PROXMOX_REPLAY}")
+            proxmox = ReplayProxmox(Cassette.load(PROXMOX_REPLAY), PROXMOX_REPLAY_LATENCY)
+        else:
+            print(f"INFO: Connecting to: {PROXMOX_HOST}")
+            print(f"INFO: User: {PROXMOX_USER}")
+            # Initialize Proxmox API with token authentication
+            proxmox = ProxmoxAPI(
+                PROXMOX_HOST,
+                user=PROXMOX_USER,
+                token_name=API_TOKEN_NAME,
+                token_value=API_TOKEN_VALUE,
+                verify_ssl=VERIFY_SSL
+            )
+        if PROXMOX_RECORD:
+            proxmox = RecordingProxmox(proxmox)
+
+        with metrics.phase("connect"):
+            # Test connection
+            with metrics.request("GET", "/version"):
+                version = proxmox.version.get()
+            print(f"INFO: Connected to Proxmox VE {version['version']}")
+
+            # Get all nodes
+            with metrics.request("GET", "/nodes"):
+                nodes = proxmox.nodes.get()
+        print(f"INFO: Found {len(nodes)} nodes: {[node['node'] for node in nodes]}")
 
-            try:
-                config = proxmox.nodes(node_name).qemu(vmid).config.get() if vtype == "qemu" else proxmox.nodes(node_name).lxc(vmid).config.get()
-            except Exception as e:
-                print(f"ERROR: Failed to get config for {vmid}: {e}")
-                continue
-
-            ostype = config.get("ostype", None)
-            ostype = None if ostype and (ostype.startswith("win") or ostype == "l26") else ostype
+    except Exception as e:
+        print(f"ERROR: Connection failed: {e}")
+        exit(1)
 
-            # Extract disk information
-            disks = []
-            if vtype == "qemu":
-                disks = extract_disk_info(config)
-            else:  # LXC
-                disks = extract_lxc_disk_info(config)
+    return proxmox, nodes
 
-            print(f"INFO: Found {len(disks)} disks for VM {vmid}")
+def save_recording(proxmox):
+    """Write the cassette of a client returned by connect() while PROXMOX_RECORD is set"""
+    if isinstance(proxmox, RecordingProxmox):
+        try:
+            proxmox.save(PROXMOX_RECORD)
+        except OSError as e:
+            print(f"ERROR: Failed to write cassette {PROXMOX_RECORD}: {e}")
 
-            interfaces = []
+def get_agent_interfaces(agent_data):
+    """Convert guest agent network-get-interfaces output to interface entries"""
+    interfaces = []
+    for iface in agent_data.get("result", []):
+        ifname = iface.get("name")
+        if should_skip_interface(ifname):
+            continue
 
-            # Try agent data for QEMU VMs only
-            if vtype == "qemu":
-                try:
-                    agent_data = proxmox.nodes(node_name).qemu(vmid).agent.get("network-get-interfaces")
+        mac = iface.get("hardware-address", "").lower()
+        ip_list = []
 
-                    for iface in agent_data.get("result", []):
-                        ifname = iface.get("name")
-                        if should_skip_interface(ifname):
-                            continue
+        for ip in iface.get("ip-addresses", []):
+            ip_addr = ip["ip-address"]
+            prefix = ip.get("prefix", 24 if ip["ip-address-type"] == "ipv4" else 64)
 
-                        mac = iface.get("hardware-address", "").lower()
-                        ip_list = []
+            # Skip loopback addresses
+            if ip_addr.startswith("127."):
+                continue
 
-                        for ip in iface.get("ip-addresses", []):
-                            ip_addr = ip["ip-address"]
-                            prefix = ip.get("prefix", 24 if ip["ip-address-type"] == "ipv4" else 64)
+            # Skip private docker networks
+            if ip_addr.startswith("172."):
+                continue
 
-                            # Skip loopback addresses
-                            if ip_addr.startswith("127."):
-                                continue
+            # Skip IPv6 link-local addresses
+            if is_ipv6(ip_addr) and ip_addr.lower().startswith("fe80::"):
+                continue
 
-                            # Skip private docker networks
-                            if ip_addr.startswith("172."):
-                                continue
+            ip_list.append({
+                "ip": ip_addr,
+                "prefix": prefix
+            })
 
-                            # Skip IPv6 link-local addresses
-                            if is_ipv6(ip_addr) and ip_addr.lower().startswith("fe80::"):
-                                continue
+        interfaces.append({
+            "name": ifname,
+            "mac": mac,
+            "ip_addresses": ip_list
+        })
+    return interfaces
 
-                            ip_list.append({
-                                "ip": ip_addr,
-                                "prefix": prefix
-                            })
+def agent_skipped(node_name, vmid, digest, cache=None):
+    """Return True if the guest's agent failed recently and its config didn't change since"""
+    failure = agent_failures.get((node_name, vmid))
+    if failure:
+        return failure[0] == digest and time.time() < failure[1]
+    return bool(cache and digest and cache.agent_skipped(node_name, vmid, digest))
+
+def agent_failed(node_name, vmid, digest, cache=None):
+    agent_failures[(node_name, vmid)] = (digest, time.time() + AGENT_RETRY_AFTER)
+    if cache and digest:
+        cache.agent_failed(node_name, vmid, digest)
+
+def agent_answered(node_name, vmid, cache=None):
+    agent_failures.pop((node_name, vmid), None)
+    if cache:
+        cache.agent_answered(node_name, vmid)
+
+def agent_enabled(config):
+    """Return True if the QEMU guest agent is enabled in the VM config ("agent: 1" or "agent: enabled=1,...")"""
+    props = parse_property_string(config.get("agent", "0"))
+    return props.get("enabled", props.get(None)) == "1"
+
+class AgentBusy(Exception):
+    """All agent slots are held by calls to agents that don't answer"""
+
+def query_agent(proxmox, node_name, vmid):
+    """Return the guest agent network-get-interfaces output, raising TimeoutError after AGENT_TIMEOUT"""
+    # The call runs on a daemon thread that is abandoned on timeout but keeps its agent slot
+    # until it ends, so hanging agents can't pile up beyond EXPORT_WORKERS calls
+    if not agent_slots.acquire(blocking=False):
+        raise AgentBusy(f"{EXPORT_WORKERS} guest agent calls are still waiting for an answer")
+    result = {}
+
+    def call():
+        try:
+            result["data"] = proxmox.nodes(node_name).qemu(vmid).agent.get("network-get-interfaces")
+        except Exception as e:
+            result["error"] = e
+        finally:
+            agent_slots.release()
+
+    with metrics.request("GET", "/nodes/{node}/qemu/{vmid}/agent/network-get-interfaces"):
+        thread = threading.Thread(target=call, name=f"agent-{vmid}", daemon=True)
+        thread.start()
+        thread.join(AGENT_TIMEOUT)
+        if thread.is_alive():
+            raise TimeoutError(f"no answer within {AGENT_TIMEOUT:g}s")
+        if "error" in result:
+            raise result["error"]
+        return result["data"]
+
+@profiling.traced("node", lambda proxmox, node_name: {"node": node_name})
+def list_node_guests(proxmox, node_name):
+    """Return (guest, type) pairs for all QEMU VMs and LXC containers on a node"""
+    with metrics.phase("inventory"):
+        with metrics.request("GET", "/nodes/{node}/qemu"):
+            vm_list = proxmox.nodes(node_name).qemu.get()
+        with metrics.request("GET", "/nodes/{node}/lxc"):
+            lxc_list = proxmox.nodes(node_name).lxc.get()
+
+    print(f"INFO: Found {len(vm_list)} QEMU VMs on {node_name}")
+    print(f"INFO: Found {len(lxc_list)} LXC containers on {node_name}")
+
+    return [(vm, "qemu") for vm in vm_list] + [(ct, "lxc") for ct in lxc_list]
+
+def list_cluster_guests(proxmox):
+    """Return {node: [(guest, type)]} of the cluster from one cluster/resources call, None if it isn't available"""
+    try:
+        with metrics.phase("inventory"), metrics.request("GET", "/cluster/resources"):
+            resources = proxmox.cluster.resources.get(type="vm")
+    except Exception as e:
+        print(f"WARN: Cluster inventory not available, listing guests per node: {e}")
+        return None
+    if not resources:
+        return None
+
+    inventory = {}
+    for res in resources:
+        if res.get("type") not in ("qemu", "lxc"):
+            continue
+        inventory.setdefault(res["node"], {"qemu": [], "lxc": []})[res["type"]].append(res)
+
+    print(f"INFO: Found {len(resources)} guests in cluster inventory")
+    return {
+        node: [(vm, "qemu") for vm in guests["qemu"]] + [(ct, "lxc") for ct in guests["lxc"]]
+        for node, guests in inventory.items()
+    }
+
+def parse_guest_config(config, vtype, vm):
+    """Extract the exported fields that only depend on the guest config"""
+    ostype = config.get("ostype", None)
+    ostype = None if ostype and (ostype.startswith("win") or ostype == "l26") else ostype
+
+    # Extract disk information
+    if vtype == "qemu":
+        disks = extract_disk_info(config)
+        interfaces = get_qemu_net_interfaces(config)  # fallback when the guest agent isn't available
+    else:  # LXC
+        disks = extract_lxc_disk_info(config)
+        interfaces = extract_lxc_net(config)
+
+    return {
+        "ostype": ostype,
+        "vcpu": config.get("cores", 1),
+        # cluster/resources entries carry maxmem in bytes, it covers configs without a memory key
+        "ram_mb": int(config.get("memory", vm.get("maxmem", 0) // (1024 * 1024))),  # Ensure integer
+        "disks": disks,
+        "interfaces": interfaces
+    }
+
+@profiling.traced("guest", lambda proxmox, node_name, vm, vtype, cache=None, digests=None: {
+    "node": node_name, "vmid": vm["vmid"], "name": vm.get("name"), "type": vtype})
+def process_guest(proxmox, node_name, vm, vtype, cache=None, digests=None):
+    """Build the Guest record for one guest, or None if its config can't be read, digests gets its config digest"""
+    vmid = vm["vmid"]
+    vm_status = vm.get("status", "unknown")
+
+    print(f"INFO: Processing {vtype} VM {vmid}: {vm['name']} (status: {vm_status})")
+
+    # Check if VM/LXC is running
+    if vm_status != "running":
+        print(f"WARN: VM {vmid} is not running, marking as offline")
+        metrics.count("guests", status="offline")
+        return Guest(name=vm["name"], type=vtype, status="offline", host=node_name, keys=Guest.OFFLINE_KEYS)
+
+    with metrics.phase("config"):
+        try:
+            with metrics.request("GET", f"/nodes/{{node}}/{vtype}/{{vmid}}/config"):
+                config = proxmox.nodes(node_name).qemu(vmid).config.get() if vtype == "qemu" else proxmox.nodes(node_name).lxc(vmid).config.get()
+        except Exception as e:
+            print(f"ERROR: Failed to get config for {vmid}: {e}")
+            metrics.count("guests", status="failed")
+            return None
+
+        # An unchanged config digest reuses the parsed config and, within AGENT_CACHE_TTL, the agent result
+        digest = config.get("digest")
+        if digests is not None:
+            digests[(vtype, vmid)] = digest
+        cached = cache.get(node_name, vmid) if cache else None
+        if cached and digest and cached["digest"] == digest:
+            print(f"INFO: Config of VM {vmid} unchanged, using cached disks and interfaces")
+            parsed = cached["parsed"]
+            metrics.count("configs", source="cache")
+        else:
+            cached = None
+            parsed = parse_guest_config(config, vtype, vm)
+            metrics.count("configs", source="parsed")
+
+    disks = parsed["disks"]
+    print(f"INFO: Found {len(disks)} disks for VM {vmid}")
 
-                        interfaces.append({
-                            "name": ifname,
-                            "mac": mac,
-                            "ip_addresses": ip_list
-                        })
+    interfaces = []
+    agent_interfaces, agent_at = None, None
+
+    # Try agent data for QEMU VMs only
+    if vtype == "qemu":
+        if cached and cached["agent_interfaces"] is not None and time.time() - cached["agent_at"] < AGENT_CACHE_TTL:
+            print(f"INFO: Using cached agent data for {vmid}")
+            agent_interfaces, agent_at = cached["agent_interfaces"], cached["agent_at"]
+            interfaces = agent_interfaces
+            metrics.count("agents", result="cached")
+        elif not agent_enabled(config):
+            print(f"INFO: Guest agent not enabled for {vmid}, using config interfaces")
+            interfaces = parsed["interfaces"]
+            metrics.count("agents", result="disabled")
+        elif agent_skipped(node_name, vmid, digest, cache):
+            print(f"INFO: Guest agent of {vmid} failed recently, using config interfaces")
+            interfaces = parsed["interfaces"]
+            metrics.count("agents", result="skipped")
+        else:
+            with metrics.phase("agent"):
+                try:
+                    agent_data = query_agent(proxmox, node_name, vmid)
+                    interfaces = get_agent_interfaces(agent_data)
+                    agent_interfaces, agent_at = interfaces, time.time()
+                    metrics.count("agents", result="answered")
+                    agent_answered(node_name, vmid, cache)
+                except AgentBusy as e:
+                    print(f"WARN: Agent of {vmid} not queried: {e}")
+                    interfaces = parsed["interfaces"]
+                    metrics.count("agents", result="busy")
                 except Exception as e:
                     print(f"WARN: Agent data not available for {vmid}: {e}")
                     # Fallback to config-based interface detection for QEMU
-                    interfaces = get_qemu_net_interfaces(config)
-            else:
-                # For LXC, always use config-based interface detection
-                interfaces = extract_lxc_net(config)
-
-            vm_data = {
-                "name": vm["name"],
-                "type": vtype,
-                "status": "running",
-                "ostype": ostype,
-                "vcpu": config.get("cores", 1),
-                "ram_mb": int(config.get("memory", 0)),  # Ensure integer
-                "disks": disks,  # Individual disk information
-                "interfaces": interfaces,
-                "host": node_name
-            }
-
-            all_vms.append(vm_data)
-
-            # Count IPv4 and IPv6 addresses for summary
-            ipv4_count = sum(len([ip for ip in iface["ip_addresses"] if not is_ipv6(ip["ip"])]) for iface in interfaces)
-            ipv6_count = sum(len([ip for ip in iface["ip_addresses"] if is_ipv6(ip["ip"])]) for iface in interfaces)
-
-            total_disk_gb = sum(disk["size_gb"] for disk in disks)
-            print(f"INFO: Added {vm['name']} with {len(interfaces)} interfaces ({ipv4_count} IPv4, {ipv6_count} IPv6), {len(disks)} disks ({total_disk_gb}GB total)")
-
-    except Exception as e:
-        print(f"ERROR: Failed to process node {node_name}: {e}")
-
-print(f"\nINFO: Total VMs processed: {len(all_vms)}")
+                    interfaces = parsed["interfaces"]
+                    metrics.count("agents", result="failed")
+                    # Don't wait for this agent again until AGENT_RETRY_AFTER has passed
+                    agent_failed(node_name, vmid, digest, cache)
+    else:
+        # For LXC, always use config-based interface detection
+        interfaces = parsed["interfaces"]
+
+    if cache and digest:
+        cache.put(node_name, vmid, digest, parsed, agent_interfaces, agent_at)
+
+    vm_data = Guest(
+        name=vm["name"],
+        type=vtype,
+        status="running",
+        ostype=parsed["ostype"],
+        vcpu=parsed["vcpu"],
+        ram_mb=parsed["ram_mb"],
+        disks=[Disk.from_dict(disk) for disk in disks],  # Individual disk information
+        interfaces=[Interface.from_dict(iface) for iface in interfaces],
+        host=node_name
+    )
 
-with open("proxmox_vms.json", "w") as f:
-    json.dump(all_vms, f, indent=2)
+    # Count IPv4 and IPv6 addresses for summary
+    ipv4_count = sum(len([ip for ip in iface["ip_addresses"] if not is_ipv6(ip["ip"])]) for iface in interfaces)
+    ipv6_count = sum(len([ip for ip in iface["ip_addresses"] if is_ipv6(ip["ip"])]) for iface in interfaces)
+
+    total_disk_gb = sum(disk["size_gb"] for disk in disks)
+    print(f"INFO: Added {vm['name']} with {len(interfaces)} interfaces ({ipv4_count} IPv4, {ipv6_count} IPv6), {len(disks)} disks ({total_disk_gb}GB total)")
+    metrics.count("guests", status="running")
+
+    return vm_data
+
+def crawl(proxmox, nodes, workers=EXPORT_WORKERS, node_workers=EXPORT_NODE_WORKERS, inventory=EXPORT_INVENTORY,
+          cache=None, guests=None, digests=None):
+    """Yield export records of all guests, or of a {node: [(guest, type)]} mapping, fetched concurrently
+
+    If digests is a dict, the config digest of each running guest is stored in it by (type, VMID).
+    """
+    # One cluster/resources call lists every guest, per-node listings are the fallback
+    cluster_guests = guests
+    if cluster_guests is None and inventory == "resources":
+        cluster_guests = list_cluster_guests(proxmox)
+    # Each node has a pool of node_workers threads, the semaphore caps the guests in flight cluster-wide
+    cluster_slots = threading.BoundedSemaphore(max(1, workers))
+    # While profiling, every node is traced from its listing to its last processed guest
+    node_spans = {}  # node -> [start, guest end times]
+
+    def process_limited(node_name, vm, vtype):
+        try:
+            with cluster_slots:
+                return process_guest(proxmox, node_name, vm, vtype, cache, digests)
+        finally:
+            if profiling.tracer.enabled:
+                node_spans[node_name][1].append(time.monotonic())
+
+    def list_limited(node_name):
+        print(f"\nINFO: Processing node: {node_name}")
+        if profiling.tracer.enabled:
+            node_spans[node_name] = [time.monotonic(), []]
+        if cluster_guests is not None:
+            return cluster_guests.get(node_name, [])
+        with cluster_slots:
+            try:
+                return list_node_guests(proxmox, node_name)
+            except Exception as e:
+                print(f"ERROR: Failed to process node {node_name}: {e}")
+                return []
 
-print("INFO: VM data exported to proxmox_vms.json")
+    node_names = [node["node"] for node in nodes]
+    node_pools = {name: ThreadPoolExecutor(max_workers=max(1, node_workers), thread_name_prefix=f"node-{name}")
+                  for name in node_names}
+    try:
+        guest_lists = [node_pools[name].submit(list_limited, name) for name in node_names]
+        node_futures = []
+        for node_name, guests in zip(node_names, guest_lists):
+            node_futures.append((node_name, [
+                node_pools[node_name].submit(process_limited, node_name, vm, vtype)
+                for vm, vtype in guests.result()
+            ]))
+
+        # Records come out in node and listing order, whatever order the guests finish in
+        for node_name, futures in node_futures:
+            for future in futures:
+                try:
+                    vm_data = future.result()
+                except Exception as e:
+                    print(f"ERROR: Failed to process guest on node {node_name}: {e}")
+                    continue
+                if vm_data:
+                    vm_data.hash = record_hash(vm_data)
+                    yield vm_data
+    finally:
+        for pool in node_pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        for node_name, (start, ends) in node_spans.items():
+            profiling.tracer.add_async(f"node {node_name}", "node", start, max(ends, default=start), {"guests": len(ends)})
+
+def write_metrics():
+    """Write this run's metrics to EXPORT_METRICS_FILE and EXPORT_REPORT_FILE, if set"""
+    try:
+        metrics.write(EXPORT_METRICS_FILE, EXPORT_REPORT_FILE)
+    except OSError as e:
+        print(f"ERROR: Failed to write metrics: {e}")
+
+def load_clusters(path):
+    """Return {name: settings} of the clusters in an INI file, one section per cluster"""
+    # Settings are environment variable names that override the cluster's environment,
+    # [DEFAULT] applies to every section
+    config = configparser.ConfigParser(interpolation=None)
+    config.optionxform = str  # keep the case of the environment variable names
+    with open(path, encoding="utf-8") as f:
+        config.read_file(f)
+
+    clusters = {}
+    for name in config.sections():
+        settings = dict(config[name])
+        missing = [key for key in ("CLUSTER_ID", "PROXMOX_HOST") if not settings.get(key)]
+        if settings.get("PROXMOX_REPLAY") and "PROXMOX_HOST" in missing:
+            missing.remove("PROXMOX_HOST")
+        if missing:
+            raise ValueError(f"cluster {name} has no {' and no '.join(missing)}")
+        clusters[name] = settings
+    if not clusters:
+        raise ValueError("no clusters configured")
+    return clusters
+
+def cluster_path(path, name):
+    """Return a per-cluster variant of a file name, e.g. export_cache.db -> export_cache.<name>.db"""
+    base, ext = os.path.splitext(path)
+    if ext == ".gz":
+        base, inner = os.path.splitext(base)
+        ext = inner + ext
+    return f"{base}.{re.sub(r'[^A-Za-z0-9_-]', '_', name)}{ext}"
+
+def relay_output(name, stream):
+    # Children print whole lines, prefixing them keeps the interleaved output readable
+    for line in stream:
+        print(f"[{name}] {line}", end="", flush=True)
+
+def export_clusters(clusters, output_file):
+    """Export the clusters of load_clusters() in parallel processes into one snapshot, returns the failed ones"""
+    failed = []
+    with tempfile.TemporaryDirectory() as work_dir, SnapshotWriter(output_file) as snapshot:
+        running = {}
+        for index, (name, settings) in enumerate(clusters.items()):
+            env = dict(os.environ, PYTHONUNBUFFERED="1", EXPORT_METRICS_FILE="",
+                       EXPORT_REPORT_FILE=os.path.join(work_dir, f"cluster-{index}.report.json"))
+            # Caches and recordings are per cluster, VMIDs and node names are only unique within one
+            for key in ("EXPORT_CACHE_FILE", "PROXMOX_RECORD"):
+                if env.get(key) and key not in settings:
+                    env[key] = cluster_path(env[key], name)
+            env.update(settings)
+            path = os.path.join(work_dir, f"cluster-{index}.jsonl")
+            command = [sys.executable, os.path.abspath(__file__), path]
+            if profiling.tracer.enabled:
+                command += ["--profile", os.path.join(work_dir, f"cluster-{index}")]
+            process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                       text=True, encoding="utf-8", errors="replace")
+            relay = threading.Thread(target=relay_output, args=(name, process.stdout), daemon=True)
+            relay.start()
+            running[name] = (index, settings["CLUSTER_ID"], process, relay, time.monotonic())
+
+        try:
+            # Finished clusters are merged right away, ones past EXPORT_CLUSTER_TIMEOUT are killed
+            # and left out, so a slow cluster doesn't hold up the others
+            while running:
+                for name, (index, cluster_id, process, relay, started) in list(running.items()):
+                    elapsed = time.monotonic() - started
+                    if process.poll() is None:
+                        if not EXPORT_CLUSTER_TIMEOUT or elapsed < EXPORT_CLUSTER_TIMEOUT:
+                            continue
+                        print(f"ERROR: Cluster {name} did not finish within {EXPORT_CLUSTER_TIMEOUT:g}s, leaving it out")
+                        process.kill()
+                        process.wait()
+                        result = "timeout"
+                    elif process.returncode:
+                        print(f"ERROR: Export of cluster {name} failed with exit code {process.returncode}, leaving it out")
+                        result = "failed"
+                    else:
+                        result = "ok"
+                    del running[name]
+                    relay.join()
+                    metrics.count("clusters", result=result)
+                    metrics.set("cluster_duration_seconds", round(elapsed, 3), cluster=name)
+                    if result != "ok":
+                        failed.append(name)
+                        continue
+
+                    prefix = os.path.join(work_dir, f"cluster-{index}")
+                    count = merge_cluster(f"{prefix}.jsonl", snapshot, name, cluster_id)
+                    metrics.set("cluster_guests", count, cluster=name)
+                    print(f"INFO: Cluster {name} (NetBox cluster {cluster_id}): {count} guests in {elapsed:.1f}s")
+                    try:
+                        with open(f"{prefix}.report.json", encoding="utf-8") as f:
+                            metrics.merge(json.load(f))
+                    except (OSError, ValueError) as e:
+                        print(f"WARN: No metrics from cluster {name}: {e}")
+                    if profiling.tracer.enabled:
+                        profiling.merge(prefix)
+                if running:
+                    time.sleep(0.1)
+        finally:
+            for _, _, process, _, _ in running.values():
+                process.kill()
+    return failed
+
+def merge_cluster(path, snapshot, name, cluster_id):
+    """Append the guests of one cluster's snapshot, tagged with the cluster, returns their number"""
+    count = 0
+    for record in read_snapshot(path):
+        record["cluster"] = name
+        record["cluster_id"] = int(cluster_id) if cluster_id.isdigit() else cluster_id
+        snapshot.write(record)
+        count += 1
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description="Export Proxmox guests to a snapshot file")
+    parser.add_argument("output_file", nargs="?", default="proxmox_vms.json",
+                        help="snapshot file (.json, .jsonl, optionally .gz), default: proxmox_vms.json")
+    parser.add_argument("--profile", metavar="PREFIX",
+                        help="write a cProfile dump to PREFIX.pstats and a span trace to PREFIX.trace.json")
+    parser.add_argument("--clusters", metavar="FILE",
+                        help="export every cluster of an INI file in parallel, one section per cluster")
+    args = parser.parse_args()
+    output_file = args.output_file
+    profiling.start(args.profile, "proxmox_export")
+
+    if args.clusters:
+        try:
+            clusters = load_clusters(args.clusters)
+        except (OSError, ValueError, configparser.Error) as e:
+            print(f"ERROR: Invalid cluster config {args.clusters}: {e}")
+            sys.exit(1)
+        print(f"INFO: Exporting {len(clusters)} clusters from {args.clusters}: {', '.join(clusters)}")
+        try:
+            failed = export_clusters(clusters, output_file)
+        finally:
+            write_metrics()
+        print(f"INFO: VM data of all clusters exported to {output_file}")
+        if failed:
+            print(f"ERROR: Missing from the snapshot: {', '.join(failed)}")
+            sys.exit(1)
+        return
+
+    proxmox, nodes = connect()
+
+    cache = ExportCache(EXPORT_CACHE_FILE) if EXPORT_CACHE_FILE else None
+    try:
+        # Records are written as they arrive, a failed crawl leaves what it got in the temporary file
+        with metrics.phase("crawl"), SnapshotWriter(output_file) as snapshot:
+            for vm_data in crawl(proxmox, nodes, cache=cache):
+                snapshot.write(vm_data)
+    except BaseException:
+        if cache:
+            cache.close()
+        raise
+    finally:
+        write_metrics()
+        save_recording(proxmox)
+    if cache:
+        # Only a complete crawl knows which guests are gone
+        cache.close(prune=True)
+
+    print(f"\nINFO: Total VMs processed: {snapshot.count}")
+    print(f"INFO: VM data exported to {output_file}")
+
+if __name__ == "__main__":
+    main()
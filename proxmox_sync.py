@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""Sync Proxmox guests into NetBox in one process
+
+Runs the export of proxmox_export.py and the import of netbox_import.py as a pipeline:
+guests are handed to the importer through a bounded queue as soon as they are crawled, so
+Proxmox reads and NetBox writes overlap. --snapshot additionally writes the crawled records
+to a snapshot file, the same as proxmox_export.py would. With --daemon it keeps running and, every
+SYNC_INTERVAL seconds, only re-exports and re-imports the guests whose change signals
+moved since the last cycle:
+
+- status, node, name, memory or CPU count in the cluster inventory,
+- an uptime reset (the guest restarted, its agent data may be different),
+- the config digest (only checked when SYNC_DIGEST_CHECK is enabled).
+
+Every SYNC_FULL_EVERY cycles all guests are synced again and the NetBox state is
+reloaded, which picks up agent-only changes (e.g. DHCP leases) and edits made in NetBox.
+"""
+
+import argparse
+import os
+import queue
+import random
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import netbox_import
+import profiling
+import proxmox_export
+from snapshot import SnapshotWriter
+
+SYNC_INTERVAL = float(os.getenv("SYNC_INTERVAL", "300"))  # seconds between daemon cycles
+SYNC_JITTER = float(os.getenv("SYNC_JITTER", "0.1"))  # +/- fraction applied to the interval
+SYNC_FULL_EVERY = int(os.getenv("SYNC_FULL_EVERY", "12"))  # cycles between full syncs, 0 disables them
+SYNC_DIGEST_CHECK = os.getenv("SYNC_DIGEST_CHECK", "true").lower() == "true"
+SYNC_QUEUE_SIZE = int(os.getenv("SYNC_QUEUE_SIZE", "500"))  # crawled guests buffered ahead of the importer
+SYNC_FLUSH_SIZE = int(os.getenv("SYNC_FLUSH_SIZE", "100"))  # guests imported per NetBox flush
+SYNC_FLUSH_WAIT = 1.0  # seconds without a new guest before pending writes are flushed anyway
+
+_DONE = object()
+
+
+def list_guests(proxmox, nodes):
+    """Return {node: [(guest, type)]} for the cluster, preferring the single inventory call"""
+    guests = proxmox_export.list_cluster_guests(proxmox)
+    if guests is not None:
+        return guests
+
+    guests = {}
+    for node in nodes:
+        try:
+            guests[node["node"]] = proxmox_export.list_node_guests(proxmox, node["node"])
+        except Exception as e:
+            print(f"ERROR: Failed to list guests on node {node['node']}: {e}")
+    return guests
+
+
+def guest_signature(node_name, vm):
+    """Cheap summary of a guest's inventory entry, a change means it needs to be synced"""
+    return (node_name, vm.get("name"), vm.get("status"), vm.get("maxmem"), vm.get("maxcpu", vm.get("cpus")))
+
+
+def fetch_digest(proxmox, node_name, vm, vtype):
+    try:
+        resource = proxmox.nodes(node_name).qemu(vm["vmid"]) if vtype == "qemu" else proxmox.nodes(node_name).lxc(vm["vmid"])
+        with proxmox_export.metrics.phase("digest"), proxmox_export.metrics.request("GET", f"/nodes/{{node}}/{vtype}/{{vmid}}/config"):
+            return resource.config.get().get("digest")
+    except Exception as e:
+        print(f"WARN: Failed to read config digest of {vm['vmid']}: {e}")
+        return None
+
+
+class SyncState:
+    """Change signals of the guests as of their last successful sync, keyed by (type, VMID)"""
+
+    def __init__(self):
+        self.signatures = {}
+        self.uptimes = {}
+        self.digests = {}
+
+    def changed_guests(self, proxmox, guests, full):
+        """Return the {node: [(guest, type)]} subset of guests that changed since the last sync"""
+        changed = {}
+        candidates = []
+        for node_name, node_guests in guests.items():
+            for vm, vtype in node_guests:
+                key = (vtype, vm["vmid"])
+                restarted = vm.get("uptime", 0) < self.uptimes.get(key, 0)
+                if full or restarted or self.signatures.get(key) != guest_signature(node_name, vm):
+                    changed.setdefault(node_name, []).append((vm, vtype))
+                elif SYNC_DIGEST_CHECK and vm.get("status") == "running":
+                    candidates.append((node_name, vm, vtype))
+
+        # Config digests need one request per guest, fetch them concurrently
+        with ThreadPoolExecutor(max_workers=max(1, proxmox_export.EXPORT_WORKERS)) as pool:
+            digests = pool.map(lambda c: fetch_digest(proxmox, *c), candidates)
+            for (node_name, vm, vtype), digest in zip(candidates, digests):
+                key = (vtype, vm["vmid"])
+                if digest is None:
+                    continue
+                if digest != self.digests.get(key):
+                    changed.setdefault(node_name, []).append((vm, vtype))
+        return changed
+
+    def record(self, guests, synced):
+        """Remember the change signals of the synced guests and forget removed ones"""
+        present = set()
+        for node_name, node_guests in guests.items():
+            for vm, vtype in node_guests:
+                key = (vtype, vm["vmid"])
+                present.add(key)
+                if key in synced:
+                    self.signatures[key] = guest_signature(node_name, vm)
+                    self.uptimes[key] = vm.get("uptime", 0)
+                    if synced[key] is not None:
+                        self.digests[key] = synced[key]
+                    else:
+                        self.digests.pop(key, None)
+
+        for table in (self.signatures, self.uptimes, self.digests):
+            for key in set(table) - present:
+                del table[key]
+
+
+def export_guests(proxmox, guests, cache, records, abort, snapshot_path=None, digests=None):
+    """Crawl the given guests into the records queue, ending with _DONE or the raised exception
+
+    Stops early once abort is set, i.e. the importer gave up and won't drain the queue anymore.
+    """
+    def hand_over(item):
+        while not abort.is_set():
+            try:
+                records.put(item, timeout=SYNC_FLUSH_WAIT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    nodes = [{"node": node_name} for node_name in guests]
+    snapshot = SnapshotWriter(snapshot_path) if snapshot_path else None
+    complete = False
+    try:
+        for vm_data in proxmox_export.crawl(proxmox, nodes, cache=cache, guests=guests, digests=digests):
+            if snapshot:
+                snapshot.write(vm_data)
+            if not hand_over(vm_data):
+                return
+        complete = True
+    except Exception as e:
+        hand_over(e)
+        return
+    finally:
+        if snapshot:
+            snapshot.close(complete)
+    hand_over(_DONE)
+
+
+def sync_guests(proxmox, guests, cache, snapshot_path=None):
+    """Export the given guests and import them into NetBox, returns {(type, VMID): digest} of the guests synced without errors"""
+    synced = {}
+    digests = {}  # (type, VMID) -> config digest the export read, filled by the export thread
+    by_name = {(node_name, vm["name"]): (vm, vtype) for node_name, node_guests in guests.items() for vm, vtype in node_guests}
+    records = queue.Queue(maxsize=max(1, SYNC_QUEUE_SIZE))
+    abort = threading.Event()
+    producer = threading.Thread(
+        target=export_guests, args=(proxmox, guests, cache, records, abort, snapshot_path, digests), name="export", daemon=True
+    )
+
+    netbox_import.import_stats.clear()
+    writer = netbox_import.BulkWriter()
+    pending = []  # (key, digest, GuestImport) of the guests queued since the last flush
+
+    def flush():
+        writer.flush()
+        # Guests with a failed write are synced again in the next cycle
+        for key, digest, guest in pending:
+            if not guest.failed:
+                synced[key] = digest
+        pending.clear()
+
+    producer.start()
+    try:
+        while True:
+            try:
+                vm_data = records.get(timeout=SYNC_FLUSH_WAIT)
+            except queue.Empty:
+                # The export is the bottleneck, don't hold the guests back for a full batch
+                if pending:
+                    flush()
+                continue
+            if vm_data is _DONE:
+                break
+            if isinstance(vm_data, Exception):
+                raise vm_data
+
+            vm, vtype = by_name[(vm_data.host, vm_data.name)]
+            guest = netbox_import.GuestImport(vm_data.name, vm_data.hash)
+            with netbox_import.metrics.phase('plan'):
+                netbox_import.import_vm(vm_data, writer, guest)
+            key = (vtype, vm["vmid"])
+            pending.append((key, digests.get(key), guest))
+            if len(pending) >= SYNC_FLUSH_SIZE:
+                flush()
+        flush()
+    finally:
+        abort.set()
+        producer.join()
+
+    netbox_import.print_summary()
+    return synced
+
+
+def run_cycle(proxmox, nodes, state, cache, full, snapshot_path=None):
+    """Sync the guests that changed (all of them if full), the metrics of both sides describe this cycle"""
+    start = time.monotonic()
+    proxmox_export.metrics.reset()
+    netbox_import.metrics.reset()
+    netbox_import.import_stats.clear()
+    total = unchanged = 0
+    try:
+        with profiling.tracer.span("full sync" if full else "sync", "cycle"):
+            total, unchanged = sync_changed(proxmox, nodes, state, cache, full, snapshot_path)
+    finally:
+        proxmox_export.write_metrics()
+        netbox_import.write_metrics(total, unchanged)
+    print(f"INFO: Cycle finished in {time.monotonic() - start:.1f}s")
+
+
+def sync_changed(proxmox, nodes, state, cache, full, snapshot_path=None):
+    """Returns the number of guests in the cluster and of those left alone as unchanged"""
+    guests = list_guests(proxmox, nodes)
+    changed = state.changed_guests(proxmox, guests, full)
+    count = sum(len(node_guests) for node_guests in changed.values())
+    total = sum(len(node_guests) for node_guests in guests.values())
+    print(f"INFO: {'Full sync' if full else 'Sync'}: {count} of {total} guests changed")
+
+    synced = {}
+    if count:
+        if full:
+            # Pick up edits made in NetBox since the last full sync
+            with netbox_import.metrics.phase('prefetch'):
+                netbox_import.prefetch_cluster_state()
+        synced = sync_guests(proxmox, changed, cache, snapshot_path)
+    state.record(guests, synced)
+    if cache:
+        cache.commit()
+    return total, total - count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync Proxmox guests into NetBox")
+    parser.add_argument("--daemon", action="store_true", help="keep running and sync changed guests every SYNC_INTERVAL seconds")
+    parser.add_argument("--snapshot", metavar="FILE", help="also write the synced guests to a snapshot file (.json, .jsonl, optionally .gz)")
+    parser.add_argument("--profile", metavar="PREFIX",
+                        help="write a cProfile dump to PREFIX.pstats and a span trace to PREFIX.trace.json at exit")
+    args = parser.parse_args()
+    profiling.start(args.profile, "proxmox_sync")
+
+    if not netbox_import.verify_cluster():
+        sys.exit(1)
+    proxmox, nodes = proxmox_export.connect()
+    cache = proxmox_export.ExportCache(proxmox_export.EXPORT_CACHE_FILE) if proxmox_export.EXPORT_CACHE_FILE else None
+    state = SyncState()
+
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        print(f"INFO: Received signal {signum}, stopping after the current cycle")
+        stop.set()
+
+    if args.daemon:
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+
+    cycle = 0
+    retry_full = False
+    try:
+        while True:
+            full = retry_full or cycle == 0 or (SYNC_FULL_EVERY > 0 and cycle % SYNC_FULL_EVERY == 0)
+            try:
+                if full and cycle:
+                    nodes = proxmox.nodes.get()
+                run_cycle(proxmox, nodes, state, cache, full, args.snapshot)
+                retry_full = False
+            except Exception as e:
+                print(f"ERROR: Sync cycle failed: {e}")
+                # A failed full sync is repeated in the next cycle instead of waiting SYNC_FULL_EVERY cycles
+                retry_full = full
+            cycle += 1
+
+            if not args.daemon or stop.is_set():
+                break
+            # Jitter keeps several daemons from hitting Proxmox and NetBox in lockstep
+            delay = SYNC_INTERVAL * random.uniform(1 - SYNC_JITTER, 1 + SYNC_JITTER)
+            print(f"INFO: Next sync in {delay:.0f}s")
+            if stop.wait(delay):
+                break
+    finally:
+        if cache:
+            cache.close()
+        proxmox_export.save_recording(proxmox)
+
+
+if __name__ == "__main__":
+    main()
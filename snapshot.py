@@ -0,0 +1,127 @@
+"""Reading and writing of proxmox_export.py snapshots
+
+A snapshot is either a JSON array of guest records (the original format) or JSON Lines with
+one guest record per line. Files ending in .gz are gzip compressed. JSON Lines snapshots are
+written and read one record at a time, so memory use doesn't grow with the number of guests.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import textwrap
+
+from models import Guest
+
+
+# Bookkeeping fields that are not part of a guest's content, the cluster tags of a
+# multi-cluster export included, so a guest hashes the same however it was exported
+META_FIELDS = ("hash", "change", "cluster", "cluster_id")
+
+
+class SnapshotError(ValueError):
+    """Raised when a snapshot file can't be parsed"""
+
+
+def is_jsonl(path):
+    """Return True if the file name selects the JSON Lines format"""
+    name = path[:-3] if path.endswith(".gz") else path
+    return name.endswith((".jsonl", ".ndjson"))
+
+
+def record_hash(record):
+    """Return a stable hash of a guest record's content, ignoring key order and META_FIELDS"""
+    if isinstance(record, Guest):
+        record = record.to_dict()
+    content = {key: value for key, value in record.items() if key not in META_FIELDS}
+    data = json.dumps(content, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+def open_snapshot(path, mode="r"):
+    """Open a snapshot file as text, transparently handling gzip"""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class SnapshotWriter:
+    """Write guest records to a temporary file as they are produced, it replaces path once complete"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        self.jsonl = is_jsonl(path)
+        self.file = gzip.open(self.tmp_path, "wt", encoding="utf-8") if path.endswith(".gz") \
+            else open(self.tmp_path, "w", encoding="utf-8")
+        self.count = 0
+        # gzip streams are only readable after close, flushing them per record just costs compression
+        self.flush_records = not path.endswith(".gz")
+
+    def write(self, record):
+        """Write a guest record, given as a dict or a Guest"""
+        if isinstance(record, Guest):
+            record = record.to_dict()
+        if self.jsonl:
+            self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        else:
+            # Same layout as json.dump(records, f, indent=2), one element at a time
+            self.file.write("[\n" if self.count == 0 else ",\n")
+            self.file.write(textwrap.indent(json.dumps(record, indent=2), "  "))
+        self.count += 1
+        if self.flush_records:
+            self.file.flush()
+
+    def close(self, complete=True):
+        """Finish the snapshot, an incomplete one is left unterminated in tmp_path and path is kept"""
+        if self.file.closed:
+            return
+        if complete and not self.jsonl:
+            self.file.write("\n]" if self.count else "[]")
+        self.file.close()
+        if complete:
+            os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(complete=exc_type is None)
+
+
+def read_snapshot(path):
+    """Yield the guest records of a snapshot
+
+    JSON Lines snapshots are parsed lazily. JSON arrays are still loaded in one go, since
+    the array format has no record boundaries to stream on. Raises SnapshotError on invalid JSON.
+    """
+    with open_snapshot(path) as f:
+        if not is_jsonl(path):
+            head = f.read(1)
+            while head and head.isspace():
+                head = f.read(1)
+            if head == "[":
+                try:
+                    records = json.loads(head + f.read())
+                except json.JSONDecodeError as e:
+                    raise SnapshotError(str(e)) from e
+                # Release each record once handed out, so converting consumers don't hold two copies
+                records.reverse()
+                while records:
+                    yield records.pop()
+                return
+            f.seek(0)
+
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                raise SnapshotError(f"line {line_number}: {e}") from e
+
+
+def read_guests(path):
+    """Yield the guest records of a snapshot as Guest objects"""
+    for record in read_snapshot(path):
+        yield Guest.from_dict(record)
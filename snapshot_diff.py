@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Compare two proxmox_export.py snapshots and write the difference as a delta snapshot
+
+The delta holds the records of guests that were added or changed in the new snapshot, with
+"change" set to "added" or "changed", and a {"name", "host", "change": "removed"} entry for
+every guest that is only in the old one. netbox_import.py imports a delta like any other
+snapshot. Guests are matched by name, the VM name in NetBox, and compared by content hash;
+only the names and hashes of the old snapshot are held in memory. In multi-cluster snapshots
+guests are matched by NetBox cluster ID and name, removed entries keep their cluster tags.
+
+    python snapshot_diff.py proxmox_vms.old.jsonl proxmox_vms.jsonl delta.jsonl
+"""
+
+import argparse
+import os
+import sys
+
+from snapshot import SnapshotError, SnapshotWriter, read_snapshot, record_hash
+
+
+def diff_snapshots(old_path, new_path, delta_path):
+    """Write the delta between two snapshots, returns a {change: count} summary"""
+    old = {}
+    for record in read_snapshot(old_path):
+        old[(record.get("cluster_id"), record["name"])] = (
+            record.get("hash") or record_hash(record), record.get("host"), record.get("cluster"))
+
+    counts = {"added": 0, "changed": 0, "removed": 0, "unchanged": 0}
+    with SnapshotWriter(delta_path) as delta:
+        for record in read_snapshot(new_path):
+            content_hash = record.get("hash") or record_hash(record)
+            previous = old.pop((record.get("cluster_id"), record["name"]), None)
+            if previous is None:
+                change = "added"
+            elif previous[0] != content_hash:
+                change = "changed"
+            else:
+                counts["unchanged"] += 1
+                continue
+            counts[change] += 1
+            delta.write(dict(record, hash=content_hash, change=change))
+
+        for (cluster_id, name), (_, host, cluster) in old.items():
+            counts["removed"] += 1
+            removed = {"name": name, "host": host, "change": "removed"}
+            if cluster_id is not None:
+                removed.update(cluster=cluster, cluster_id=cluster_id)
+            delta.write(removed)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the difference between two snapshots as a delta snapshot")
+    parser.add_argument("old", help="previous snapshot")
+    parser.add_argument("new", help="current snapshot")
+    parser.add_argument("delta", help="delta file to write (.json, .jsonl, optionally .gz)")
+    args = parser.parse_args()
+
+    for path in (args.old, args.new):
+        if not os.path.exists(path):
+            print(f"ERROR: File not found: {path}")
+            sys.exit(1)
+
+    try:
+        counts = diff_snapshots(args.old, args.new, args.delta)
+    except SnapshotError as e:
+        print(f"ERROR: Invalid JSON file: {e}")
+        sys.exit(1)
+
+    print(f"INFO: {counts['added']} added, {counts['changed']} changed, {counts['removed']} removed, "
+          f"{counts['unchanged']} unchanged guests")
+    print(f"INFO: Delta written to {args.delta}")
+
+
+if __name__ == "__main__":
+    main()